@@ -0,0 +1,59 @@
+"""
+Run the benchmarks:
+
+    python -m HashomerCryptoRef.benchmarks [--infected-users N] [--contacts-per-user N] [--retention-days N]
+                                          [--only NAME ...] [--output results.json] [--baseline baseline.json]
+
+Exits with status 1 if a benchmark regressed against the baseline.
+"""
+
+import argparse
+import sys
+from .suite import BENCHMARKS, REGRESSION_TOLERANCE, Params, run_benchmarks, save_results, load_results, compare
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m HashomerCryptoRef.benchmarks',
+                                     description='Benchmarks of the Hashomer reference implementation.')
+    defaults = Params()
+    parser.add_argument('--infected-users', type=int, default=defaults.infected_users)
+    parser.add_argument('--contacts-per-user', type=int, default=defaults.contacts_per_user)
+    parser.add_argument('--retention-days', type=int, default=defaults.retention_days)
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS.keys()), help='benchmarks to run (default: all)')
+    parser.add_argument('--no-memory', action='store_true', help='do not measure the peak memory')
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--baseline', help='results saved by --output to compare against')
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE,
+                        help='relative drop of throughput reported as a regression (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    params = Params(args.infected_users, args.contacts_per_user, args.retention_days, args.seed)
+    results = run_benchmarks(params, args.only, not args.no_memory)
+
+    print('{:<24}{:>16}  {:<12}{:>11}{:>11}{:>11}{:>12}'.format(
+        'benchmark', 'throughput', '', 'p50 ms', 'p90 ms', 'p99 ms', 'peak KiB'))
+    for name, result in results.items():
+        latency = result.to_dict()['latency']
+        peak = '-' if result.peak_memory is None else '{:.0f}'.format(result.peak_memory / 1024)
+        print('{:<24}{:>16.1f}  {:<12}{:>11.3f}{:>11.3f}{:>11.3f}{:>12}'.format(
+            name, result.throughput, result.unit + '/s', 1000 * latency['p50'], 1000 * latency['p90'],
+            1000 * latency['p99'], peak))
+
+    if args.output:
+        save_results(args.output, params, results)
+
+    regressed = False
+    if args.baseline:
+        baseline = load_results(args.baseline)
+        if baseline['params'] != params.to_dict():
+            print('warning: the baseline was run with {}'.format(baseline['params']))
+        print()
+        for name, expected, throughput, is_regression in compare(results, baseline, args.tolerance):
+            print('{:<24}{:>+9.1%}{}'.format(name, throughput / expected - 1, '  REGRESSION' if is_regression else ''))
+            regressed = regressed or is_regression
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
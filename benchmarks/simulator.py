@@ -0,0 +1,276 @@
+"""
+Deterministic simulation of a city population, driving User and Server end to end:
+
+    python -m HashomerCryptoRef.benchmarks.simulator [--population N] [--days N] [--infected-fraction F]
+                                                    [--places N] [--seed N] [--trace-memory] [--output sim.json]
+
+People spend the day at home and visit public places (a few regular ones and some random ones).
+People at the same place during the same unit hear each other's EphIDs with some probability.
+"""
+
+import argparse
+import json
+import random
+import time
+import tracemalloc
+from collections import OrderedDict
+from typing import List, Tuple
+from ..source.user import User
+from ..source.server import Server
+from ..source.matching import MaskCache
+from ..source.time import UNITS_IN_DAY, UNITS_IN_EPOCH, T_UNIT, day_to_second, split_unit_ordinal
+
+# Day of the first simulated day
+START_DAY = 18400
+GEOHASH_LEN = 5
+# Visits happen between these units of the day (7:00 to 22:00)
+FIRST_VISIT_UNIT = 7 * UNITS_IN_EPOCH
+LAST_VISIT_UNIT = 22 * UNITS_IN_EPOCH
+
+
+class SimulationParams:
+    def __init__(self, population: int = 200, days: int = 3, infected_fraction: float = 0.05, places: int = 40,
+                 regular_places: int = 2, visits_per_day: int = 4, visit_units: Tuple[int, int] = (2, 24),
+                 ble_probability: float = 0.3, use_day_keys: bool = False, seed: int = 0):
+        """
+        :param population:          number of users.
+        :param days:                number of simulated days.
+        :param infected_fraction:   fraction of the users who upload their keys at the end.
+        :param places:              number of public places.
+        :param regular_places:      number of places every user visits regularly (e.g. work).
+        :param visits_per_day:      maximal number of visits of a user in a day.
+        :param visit_units:         (min, max) length of a visit, in units.
+        :param ble_probability:     probability that a user hears another user at the same place during a unit.
+        :param use_day_keys:        infected users upload day keys (see User.get_keys_for_server).
+        :param seed:                seed of the simulation.
+        """
+        self.population = population
+        self.days = days
+        self.infected_fraction = infected_fraction
+        self.places = places
+        self.regular_places = regular_places
+        self.visits_per_day = visits_per_day
+        self.visit_units = visit_units
+        self.ble_probability = ble_probability
+        self.use_day_keys = use_day_keys
+        self.seed = seed
+
+    def to_dict(self) -> dict:
+        return dict(self.__dict__)
+
+
+def place_geohash(place: int) -> bytes:
+    return place.to_bytes(GEOHASH_LEN, 'big')
+
+
+class Simulator:
+    def __init__(self, params: SimulationParams, trace_memory: bool = False):
+        """
+        :param params:          simulation parameters.
+        :param trace_memory:    measure the peak memory of every stage with tracemalloc (slows the stages down).
+        """
+        self.params = params
+        self.trace_memory = trace_memory
+        self.rng = random.Random(params.seed)
+        # self.stages[name] = {'seconds': duration, 'peak_memory': bytes allocated at peak (None if not traced)}
+        self.stages = OrderedDict()
+        self.counts = OrderedDict()
+
+        self.users = []
+        self.server = Server()
+        # self.visits[day][person] = [(first unit, last unit + 1, place)] sorted by time
+        self.visits = {}
+        # self.schedules[(person, day)] = [EphID of every unit of the day]
+        self.schedules = {}
+        # [(receiver, sender, contact time, unit of the day, day)] of every BLE message heard
+        self.sightings = []
+        # [(receiver, sender)] of every stored contact
+        self.accepted = []
+        self.infected = []
+        self.matches = {}
+
+    def _stage(self, name: str, function) -> None:
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            function()
+        finally:
+            seconds = time.perf_counter() - start
+            peak_memory = None
+            if self.trace_memory:
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+        self.stages[name] = {'seconds': seconds, 'peak_memory': peak_memory}
+
+    def run(self) -> dict:
+        """
+        Run all the stages in order.
+        :return:    the results (see results).
+        """
+        self._stage('create_users', self.create_users)
+        self._stage('movement', self.simulate_movement)
+        self._stage('advertise', self.advertise)
+        self._stage('encounters', self.simulate_encounters)
+        self._stage('store_contacts', self.store_contacts)
+        self._stage('upload', self.upload)
+        self._stage('matching', self.match)
+        self._stage('verification', self.verify)
+        return self.results()
+
+    def create_users(self) -> None:
+        install_time = day_to_second(START_DAY)
+        last_time = day_to_second(START_DAY + self.params.days) - 1
+        for person in range(self.params.population):
+            user = User(person.to_bytes(16, 'big'), bytes(self.rng.randrange(256) for _ in range(16)), install_time)
+            user.update_key_databases(install_time, last_time)
+            self.users.append(user)
+        self.counts['users'] = len(self.users)
+
+    def simulate_movement(self) -> None:
+        params = self.params
+        regular = [self.rng.sample(range(params.places), min(params.regular_places, params.places))
+                   for _ in range(params.population)]
+        for day in range(START_DAY, START_DAY + params.days):
+            self.visits[day] = []
+            for person in range(params.population):
+                visits = []
+                unit = FIRST_VISIT_UNIT + self.rng.randrange(2 * UNITS_IN_EPOCH)
+                for _ in range(self.rng.randrange(params.visits_per_day + 1)):
+                    length = self.rng.randint(*params.visit_units)
+                    if unit + length > LAST_VISIT_UNIT:
+                        break
+                    if len(regular[person]) > 0 and self.rng.random() < 0.6:
+                        place = self.rng.choice(regular[person])
+                    else:
+                        place = self.rng.randrange(params.places)
+                    visits.append((unit, unit + length, place))
+                    unit += length + self.rng.randrange(12)
+                self.visits[day].append(visits)
+        self.counts['visits'] = sum(len(visits) for day_visits in self.visits.values() for visits in day_visits)
+
+    def _home(self, person: int) -> bytes:
+        # Homes are private places, after the public ones
+        return place_geohash(self.params.places + person)
+
+    def advertise(self) -> None:
+        """
+        Every user generates the EphIDs of every day at once, for its location timeline.
+        """
+        for day, day_visits in self.visits.items():
+            for person, visits in enumerate(day_visits):
+                timeline = [(day_to_second(day), self._home(person))]
+                for first, last, place in visits:
+                    timeline.append((day_to_second(day) + first * T_UNIT, place_geohash(place)))
+                    timeline.append((day_to_second(day) + last * T_UNIT, self._home(person)))
+                self.schedules[(person, day)] = self.users[person].generate_ephemeral_ids(day, timeline)
+        self.counts['ephids'] = len(self.schedules) * UNITS_IN_DAY
+
+    def simulate_encounters(self) -> None:
+        """
+        Users at the same place during a unit hear each other with probability ble_probability.
+        """
+        for day, day_visits in self.visits.items():
+            # present[(unit, place)] = [people]
+            present = {}
+            for person, visits in enumerate(day_visits):
+                for first, last, place in visits:
+                    for unit in range(first, last):
+                        present.setdefault((unit, place), []).append(person)
+            for (unit, place), people in sorted(present.items()):
+                for receiver in people:
+                    for sender in people:
+                        if sender != receiver and self.rng.random() < self.params.ble_probability:
+                            contact_time = day_to_second(day) + unit * T_UNIT + self.rng.randrange(T_UNIT)
+                            self.sightings.append((receiver, sender, contact_time, unit, day))
+        self.counts['sightings'] = len(self.sightings)
+
+    def store_contacts(self) -> None:
+        by_receiver = {}
+        for receiver, sender, contact_time, unit, day in self.sightings:
+            by_receiver.setdefault(receiver, []).append((contact_time, sender, unit, day))
+
+        for receiver in sorted(by_receiver.keys()):
+            sightings = sorted(by_receiver[receiver])
+            batch = [(self.schedules[(sender, day)][unit], self.rng.randrange(-90, -40), contact_time,
+                      self._location(receiver, day, unit)) for contact_time, sender, unit, day in sightings]
+            results = self.users[receiver].store_contacts(batch)
+            self.accepted += [(receiver, sender) for (_, sender, _, _), result in zip(sightings, results) if result]
+        self.counts['stored_contacts'] = len(self.accepted)
+
+    def _location(self, person: int, day: int, unit: int) -> bytes:
+        for first, last, place in self.visits[day][person]:
+            if first <= unit < last:
+                return place_geohash(place)
+        return self._home(person)
+
+    def upload(self) -> None:
+        count = int(round(self.params.infected_fraction * self.params.population))
+        self.infected = sorted(self.rng.sample(range(self.params.population), count))
+        for person in self.infected:
+            self.server.receive_user_key(self.users[person].get_keys_for_server(self.params.use_day_keys))
+        self.counts['infected'] = len(self.infected)
+
+    def match(self) -> None:
+        """
+        Every user with contacts matches against the published keys. The masks are shared between users.
+        """
+        server_msg = self.server.send_keys()
+        self.counts['published_keys'] = sum(len(keys) for epochs in server_msg.values() for keys in epochs.values())
+        mask_cache = MaskCache()
+        for person, user in enumerate(self.users):
+            if len(user.contacts) > 0:
+                user.mask_cache = mask_cache
+                self.matches[person] = user.find_crypto_matches(server_msg)
+        self.counts['matches'] = sum(len(matches) for matches in self.matches.values())
+        self.counts['exposed_users'] = sum(1 for matches in self.matches.values() if len(matches) > 0)
+        infected = set(self.infected)
+        self.counts['expected_matches'] = sum(1 for _, sender in self.accepted if sender in infected)
+
+    def verify(self) -> None:
+        claims = []
+        for matches in self.matches.values():
+            for match in matches:
+                day, epoch, _ = split_unit_ordinal(match.infected_unit)
+                claims.append((day, epoch, match.proof))
+        self.counts['verified'] = sum(self.server.verify_contacts(claims))
+
+    def results(self) -> dict:
+        return {'params': self.params.to_dict(), 'stages': dict(self.stages), 'counts': dict(self.counts)}
+
+
+def main(argv: List[str] = None) -> dict:
+    parser = argparse.ArgumentParser(prog='python -m HashomerCryptoRef.benchmarks.simulator',
+                                     description='Simulate a population of users end to end.')
+    defaults = SimulationParams()
+    parser.add_argument('--population', type=int, default=defaults.population)
+    parser.add_argument('--days', type=int, default=defaults.days)
+    parser.add_argument('--infected-fraction', type=float, default=defaults.infected_fraction)
+    parser.add_argument('--places', type=int, default=defaults.places)
+    parser.add_argument('--ble-probability', type=float, default=defaults.ble_probability)
+    parser.add_argument('--use-day-keys', action='store_true')
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--trace-memory', action='store_true', help='measure the peak memory of every stage')
+    parser.add_argument('--output', help='save the results as JSON')
+    args = parser.parse_args(argv)
+
+    params = SimulationParams(population=args.population, days=args.days, infected_fraction=args.infected_fraction,
+                              places=args.places, ble_probability=args.ble_probability,
+                              use_day_keys=args.use_day_keys, seed=args.seed)
+    results = Simulator(params, args.trace_memory).run()
+
+    for name, stage in results['stages'].items():
+        peak = '' if stage['peak_memory'] is None else '{:>12.0f} KiB'.format(stage['peak_memory'] / 1024)
+        print('{:<16}{:>10.3f} s{}'.format(name, stage['seconds'], peak))
+    print()
+    for name, count in results['counts'].items():
+        print('{:<16}{:>10}'.format(name, count))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
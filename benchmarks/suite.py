@@ -0,0 +1,301 @@
+"""
+Benchmarks of the key derivation, EphID generation, server ingest, key publishing, contact verification and matching.
+Every benchmark times a number of calls of one operation, after a setup which is not timed.
+"""
+
+import json
+import random
+import time
+import tracemalloc
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple
+from ..source.user import User
+from ..source.server import Server
+from ..source.matching import MaskCache
+from ..source.time import EPOCHS_IN_DAY, UNITS_IN_DAY, T_UNIT, JITTER_THRESHOLD, RETENTION_DAYS
+from ..source.time import day_to_second, epoch_ordinal
+
+# Day of the first key of every scenario
+START_DAY = 18400
+GEOHASH_LEN = 5
+# Default relative drop of throughput reported as a regression
+REGRESSION_TOLERANCE = 0.2
+
+
+class Params:
+    def __init__(self, infected_users: int = 20, contacts_per_user: int = 5,
+                 retention_days: int = RETENTION_DAYS, seed: int = 0):
+        """
+        :param infected_users:      number of infected users uploading keys.
+        :param contacts_per_user:   number of contacts the observer has with every infected user.
+        :param retention_days:      number of days of keys of every user.
+        :param seed:                seed of the scenario.
+        """
+        self.infected_users = infected_users
+        self.contacts_per_user = contacts_per_user
+        self.retention_days = retention_days
+        self.seed = seed
+
+    def to_dict(self) -> dict:
+        return dict(self.__dict__)
+
+
+class Result:
+    def __init__(self, name: str, latencies: List[float], ops_per_call: int, unit: str, peak_memory: int = None):
+        """
+        :param name:            benchmark name.
+        :param latencies:       duration of every call, in seconds.
+        :param ops_per_call:    number of operations done by a call (e.g. keys derived).
+        :param unit:            name of the operation.
+        :param peak_memory:     peak of the memory allocated by the calls, in bytes (None if not measured).
+        """
+        self.name = name
+        self.latencies = latencies
+        self.ops_per_call = ops_per_call
+        self.unit = unit
+        self.peak_memory = peak_memory
+
+    @property
+    def throughput(self) -> float:
+        """
+        Operations per second of the median call, so that a single slow call does not skew comparisons.
+        """
+        median = self.percentile(50)
+        return self.ops_per_call / median if median > 0 else 0.0
+
+    def percentile(self, q: float) -> float:
+        """
+        :param q:   percentile, 0 to 100.
+        :return:    latency of a call at the percentile (nearest rank), in seconds.
+        """
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))]
+
+    def to_dict(self) -> dict:
+        return {
+            'calls': len(self.latencies),
+            'ops_per_call': self.ops_per_call,
+            'unit': self.unit,
+            'seconds': sum(self.latencies),
+            'throughput': self.throughput,
+            'latency': {'p50': self.percentile(50), 'p90': self.percentile(90),
+                        'p99': self.percentile(99), 'max': max(self.latencies)},
+            'peak_memory': self.peak_memory,
+        }
+
+
+class Scenario:
+    def __init__(self, params: Params):
+        """
+        Infected users with keys for params.retention_days days, and an observer who met each of them
+        params.contacts_per_user times (with jitter), plus as many contacts with strangers.
+        """
+        self.params = params
+        rng = random.Random(params.seed)
+        self.install_time = day_to_second(START_DAY)
+        self.last_time = day_to_second(START_DAY + params.retention_days) - 1
+
+        self.infected = []
+        sightings = []
+        for i in range(params.infected_users):
+            user = User(bytes([i % 256] * 16), bytes(rng.randrange(256) for _ in range(16)), self.install_time)
+            user.update_key_databases(self.install_time, self.last_time)
+            for _ in range(params.contacts_per_user):
+                contact_time = rng.randrange(self.install_time, self.last_time)
+                ephid = user.generate_ephemeral_id(contact_time, random_geohash(rng))
+                sightings.append((contact_time + rng.randrange(-JITTER_THRESHOLD // 2, JITTER_THRESHOLD // 2), ephid))
+            self.infected.append(user)
+        for _ in range(params.infected_users * params.contacts_per_user):
+            sightings.append((rng.randrange(self.install_time, self.last_time), bytes(rng.randrange(256) for _ in range(16))))
+        self.sightings = sorted(sightings)
+
+    def observer(self) -> User:
+        observer = User(bytes([255] * 16), bytes([254] * 16), self.install_time)
+        observer.store_contacts([(ephid, None, contact_time, bytes(GEOHASH_LEN)) for contact_time, ephid in self.sightings])
+        return observer
+
+    def server(self) -> Server:
+        server = Server(retention_days=self.params.retention_days)
+        server.receive_user_keys([user.get_keys_for_server() for user in self.infected])
+        return server
+
+    def fresh_user(self) -> User:
+        """
+        :return:    a user with keys for params.retention_days days, none of them derived yet.
+        """
+        user = User(bytes([253] * 16), bytes([252] * 16), self.install_time)
+        user.update_key_databases(self.install_time, self.last_time)
+        return user
+
+
+def random_geohash(rng: random.Random) -> bytes:
+    return bytes(rng.randrange(256) for _ in range(GEOHASH_LEN))
+
+
+# A benchmark returns (setup, step, calls, ops_per_call, unit): setup() builds the state, step(state, i) is timed.
+Benchmark = Tuple[Callable[[], object], Callable[[object, int], object], int, int, str]
+
+
+def bench_derive_epoch_keys(scenario: Scenario) -> Benchmark:
+    def setup():
+        return User(bytes([1] * 16), bytes([2] * 16), scenario.install_time)
+
+    def step(user: User, i: int):
+        day = START_DAY + 1 + i
+        user._get_epoch_keys(day)
+        for epoch in range(EPOCHS_IN_DAY):
+            epoch_key = user.epoch_keys.get(epoch_ordinal(day, epoch))
+            _ = epoch_key.epochENC, epoch_key.epochMAC, epoch_key.epochVER
+
+    return setup, step, scenario.params.retention_days, EPOCHS_IN_DAY, 'epoch keys'
+
+
+def bench_generate_ephemeral_id(scenario: Scenario) -> Benchmark:
+    geo_hash = bytes(GEOHASH_LEN)
+
+    def step(user: User, i: int):
+        user.generate_ephemeral_id(scenario.install_time + i * T_UNIT, geo_hash)
+
+    return scenario.fresh_user, step, UNITS_IN_DAY, 1, 'EphIDs'
+
+
+def bench_ephemeral_id_schedule(scenario: Scenario) -> Benchmark:
+    geo_hashes = [(scenario.install_time, bytes(GEOHASH_LEN))]
+
+    def step(user: User, i: int):
+        user.generate_ephemeral_ids(START_DAY + i % scenario.params.retention_days, geo_hashes)
+
+    return scenario.fresh_user, step, scenario.params.retention_days, UNITS_IN_DAY, 'EphIDs'
+
+
+def bench_receive_user_key(scenario: Scenario) -> Benchmark:
+    def setup():
+        return Server(retention_days=scenario.params.retention_days), \
+               [user.get_keys_for_server() for user in scenario.infected]
+
+    def step(state, i: int):
+        server, user_keys = state
+        server.receive_user_key(user_keys[i])
+
+    keys_per_user = EPOCHS_IN_DAY * scenario.params.retention_days
+    return setup, step, len(scenario.infected), keys_per_user, 'epoch keys'
+
+
+def bench_send_keys(scenario: Scenario) -> Benchmark:
+    keys = len(scenario.infected) * EPOCHS_IN_DAY * scenario.params.retention_days
+
+    def step(server: Server, i: int):
+        server.send_keys()
+
+    return scenario.server, step, 5, keys, 'epoch keys'
+
+
+def bench_verify_contact(scenario: Scenario) -> Benchmark:
+    rng = random.Random(scenario.params.seed)
+    claims = []
+    for user in scenario.infected:
+        for _ in range(scenario.params.contacts_per_user):
+            day = START_DAY + rng.randrange(scenario.params.retention_days)
+            epoch = rng.randrange(EPOCHS_IN_DAY)
+            claims.append((day, epoch, user.epoch_keys.get(epoch_ordinal(day, epoch)).epochVER[:4]))
+            claims.append((day, epoch, bytes(rng.randrange(256) for _ in range(4))))
+
+    def step(server: Server, i: int):
+        server.verify_contact(*claims[i])
+
+    return scenario.server, step, len(claims), 1, 'claims'
+
+
+def bench_find_crypto_matches(scenario: Scenario) -> Benchmark:
+    def setup():
+        return scenario.observer(), scenario.server().send_keys()
+
+    def step(state, i: int):
+        observer, server_msg = state
+        # Every call derives the masks from scratch
+        observer.mask_cache = MaskCache()
+        observer.find_crypto_matches(server_msg)
+
+    return setup, step, 3, len(scenario.sightings), 'contacts'
+
+
+BENCHMARKS = OrderedDict([
+    ('derive_epoch_keys', bench_derive_epoch_keys),
+    ('generate_ephemeral_id', bench_generate_ephemeral_id),
+    ('ephemeral_id_schedule', bench_ephemeral_id_schedule),
+    ('receive_user_key', bench_receive_user_key),
+    ('send_keys', bench_send_keys),
+    ('verify_contact', bench_verify_contact),
+    ('find_crypto_matches', bench_find_crypto_matches),
+])
+
+
+def run_benchmark(name: str, scenario: Scenario, measure_memory: bool = True) -> Result:
+    """
+    Time every call of a benchmark, after an untimed warmup call on a state of its own.
+    The peak memory is measured on a second run under tracemalloc, so that tracing does not slow down the timed run.
+    """
+    setup, step, calls, ops_per_call, unit = BENCHMARKS[name](scenario)
+
+    step(setup(), 0)
+    state = setup()
+    latencies = []
+    for i in range(calls):
+        start = time.perf_counter()
+        step(state, i)
+        latencies.append(time.perf_counter() - start)
+
+    peak_memory = None
+    if measure_memory:
+        state = setup()
+        tracemalloc.start()
+        try:
+            for i in range(calls):
+                step(state, i)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return Result(name, latencies, ops_per_call, unit, peak_memory)
+
+
+def run_benchmarks(params: Params, names: List[str] = None, measure_memory: bool = True) -> Dict[str, Result]:
+    """
+    :param params:          scenario parameters.
+    :param names:           benchmarks to run (default: all, see BENCHMARKS).
+    :param measure_memory:  measure the peak memory of every benchmark.
+    :return:                results by benchmark name.
+    """
+    scenario = Scenario(params)
+    names = list(BENCHMARKS.keys()) if names is None else names
+    return OrderedDict((name, run_benchmark(name, scenario, measure_memory)) for name in names)
+
+
+def save_results(path: str, params: Params, results: Dict[str, Result]) -> None:
+    with open(path, 'w') as f:
+        json.dump({'params': params.to_dict(),
+                   'results': {name: result.to_dict() for name, result in results.items()}}, f, indent=2)
+
+
+def load_results(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(results: Dict[str, Result], baseline: dict,
+            tolerance: float = REGRESSION_TOLERANCE) -> List[Tuple[str, float, float, bool]]:
+    """
+    Compare throughputs (of the median calls, see Result.throughput) against saved results.
+
+    :param results:     results of run_benchmarks.
+    :param baseline:    results loaded by load_results.
+    :param tolerance:   relative drop of throughput which is reported as a regression.
+    :return:            list of (benchmark name, baseline throughput, throughput, regressed),
+                        for the benchmarks present in both.
+    """
+    comparison = []
+    for name, result in results.items():
+        if name not in baseline['results']:
+            continue
+        expected = baseline['results'][name]['throughput']
+        comparison.append((name, expected, result.throughput, result.throughput < (1 - tolerance) * expected))
+    return comparison
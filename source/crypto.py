@@ -1,5 +1,8 @@
+from typing import List
+from collections import OrderedDict
 from hashlib import sha256
 import hmac
+from . import stats
 
 use_cryptography = True
 try:
@@ -12,6 +15,8 @@ except ImportError:
 
 AES_BLOCK_SIZE = 16
 KEY_LEN = 16
+# Default number of keys whose HMAC contexts are kept by HmacCache
+HMAC_CACHE_SIZE = 256
 
 
 def hmac_sha256(key: bytes, data: bytes) -> bytes:
@@ -23,9 +28,78 @@ def hmac_sha256(key: bytes, data: bytes) -> bytes:
     """
 
     assert len(key) == KEY_LEN, "We only support 128 bit key, but len(key) = {})".format(len(key))
+    if stats.enabled:
+        stats.count('crypto.hmac')
     return hmac.new(key, data, sha256).digest()
 
 
+class HmacKey:
+    def __init__(self, key: bytes):
+        """
+        HMAC-SHA256 context bound to a single key.
+        The inner and outer states are hashed once, and copied for every message signed under the key.
+
+        :param key:     array of size 16 bytes.
+        """
+        assert len(key) == KEY_LEN, "We only support 128 bit key, but len(key) = {})".format(len(key))
+        self._context = hmac.new(key, digestmod=sha256)
+
+    def digest(self, data: bytes) -> bytes:
+        """
+        :param data:    data to sign.
+        :return:        the HMAC of data under the key, like hmac_sha256.
+        """
+        if stats.enabled:
+            stats.count('crypto.hmac')
+        context = self._context.copy()
+        context.update(data)
+        return context.digest()
+
+
+class HmacCache:
+    def __init__(self, max_keys: int = HMAC_CACHE_SIZE):
+        """
+        HMAC contexts of recently used keys. The least recently used contexts are evicted above max_keys.
+        Only long-lived keys which sign many messages should go through the cache, since it keeps the keys
+        in memory until they are evicted or the cache is cleared.
+
+        :param max_keys:    maximal number of keys to keep.
+        """
+        self.max_keys = max_keys
+        self._contexts = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._contexts)
+
+    def get(self, key: bytes) -> HmacKey:
+        key = bytes(key)
+        context = self._contexts.get(key)
+        if context is not None:
+            self._contexts.move_to_end(key)
+            return context
+        context = HmacKey(key)
+        self._contexts[key] = context
+        while len(self._contexts) > self.max_keys:
+            self._contexts.popitem(last=False)
+        return context
+
+    def clear(self) -> None:
+        self._contexts.clear()
+
+
+HMAC_CACHE = HmacCache()
+
+
+def hmac_sha256_cached(key: bytes, data: bytes) -> bytes:
+    """
+    hmac_sha256 reusing the context of the key from HMAC_CACHE, for keys which sign many messages.
+    :param key:     array of size 16 bytes.
+    :param data:    data to sign.
+    :return:
+    """
+    return HMAC_CACHE.get(key).digest(data)
+
+
 def encrypt_cryptography(key: bytes, plain: bytes) -> bytes:
     cipher = Cipher(algorithms.AES(key), modes.ECB(), backend=default_backend())
     encryptor = cipher.encryptor()
@@ -38,6 +112,58 @@ def encrypt_cryptodome(key: bytes, plain: bytes) -> bytes:
     return cipher.encrypt(plain)
 
 
+class Encryptor:
+    def __init__(self, key: bytes):
+        """
+        AES-ECB encryption context bound to a single key.
+        The backend cipher is set up once and reused for every block encrypted under the key.
+
+        :param key:     array of size 16 bytes.
+        """
+        assert len(key) == KEY_LEN, "We only support 128 bit key, but len(key) = {})".format(len(key))
+
+        if use_cryptography:
+            self._update = Cipher(algorithms.AES(key), modes.ECB(), backend=default_backend()).encryptor().update
+        else:
+            self._update = AES.new(key, AES.MODE_ECB).encrypt
+
+    def encrypt(self, plain: bytes) -> bytes:
+        """
+        Encrypt a single block.
+        :param plain:   array of size 16 bytes.
+        :return:        the encrypted array is size 16 bytes.
+        """
+        assert len(plain) == AES_BLOCK_SIZE, "Expected a single block, but len(plain) = {}".format(len(plain))
+        if stats.enabled:
+            stats.count('crypto.aes_calls')
+            stats.count('crypto.aes_blocks')
+        return self._update(plain)
+
+    def encrypt_many(self, blocks: List[bytes]) -> List[bytes]:
+        """
+        Encrypt many blocks in a single backend call.
+        :param blocks:  list of arrays of size 16 bytes.
+        :return:        list of encrypted arrays of size 16 bytes, in the same order.
+        """
+        data = b''.join(blocks)
+        assert len(data) == AES_BLOCK_SIZE * len(blocks), "All blocks must be of size {}".format(AES_BLOCK_SIZE)
+        if stats.enabled:
+            stats.count('crypto.aes_calls')
+            stats.count('crypto.aes_blocks', len(blocks))
+        cipher = self._update(data)
+        return [cipher[i:i + AES_BLOCK_SIZE] for i in range(0, len(cipher), AES_BLOCK_SIZE)]
+
+
+def encrypt_many(key: bytes, blocks: List[bytes]) -> List[bytes]:
+    """
+    Encrypt many blocks with AES encryption under the same key.
+    :param key:     array of size 16 bytes.
+    :param blocks:  list of arrays of size 16 bytes.
+    :return:        list of encrypted arrays of size 16 bytes, in the same order.
+    """
+    return Encryptor(key).encrypt_many(blocks)
+
+
 def encrypt(key: bytes, plain: bytes) -> bytes:
     """
     Encrypt a block with AES encryption.
@@ -48,6 +174,9 @@ def encrypt(key: bytes, plain: bytes) -> bytes:
 
     assert len(key) == KEY_LEN, "We only support 128 bit key, but len(key) = {})".format(len(key))
     assert len(plain) == KEY_LEN, "We only support 128 bit key, but len(key) = {})".format(len(key))
+    if stats.enabled:
+        stats.count('crypto.aes_calls')
+        stats.count('crypto.aes_blocks')
 
     if use_cryptography:
         return encrypt_cryptography(key, plain)
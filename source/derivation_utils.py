@@ -1,6 +1,7 @@
-from typing import Tuple
-from .crypto import encrypt, hmac_sha256 as hmac
+from typing import List, Tuple
+from .crypto import Encryptor, HmacKey, encrypt_many, hmac_sha256 as hmac, hmac_sha256_cached
 from .bytes_utils import num_to_bytes, STRINGS
+from .time import EPOCHS_IN_DAY
 
 
 KEY_LEN = 16
@@ -15,19 +16,48 @@ def get_key_epoch(pre_key: bytes, commit: bytes, day: bytes, epoch: bytes) -> by
 
 
 def get_key_commit_i(key_master_com: bytes, day: bytes) -> bytes:
-    assert len(day) == 4
-    return encrypt(key_master_com, day + b'\x00' * 12)
+    return get_key_commits(key_master_com, [day])[0]
+
+
+def get_key_commits(key_master_com: bytes, days: List[bytes]) -> List[bytes]:
+    # All daily commitment keys are encrypted under key_master_com, so derive them in a single call.
+    assert all(len(day) == 4 for day in days)
+    return encrypt_many(key_master_com, [day + b'\x00' * 12 for day in days])
 
 
 def get_epoch_keys(epoch_key: bytes, day: int, epoch: int) -> Tuple[bytes, bytes]:
     prefix = num_to_bytes(day, 4) + num_to_bytes(epoch, 1)
-    epoch_enc = encrypt(epoch_key, prefix + b'\x00'*11)
-    epoch_mac = encrypt(epoch_key, prefix + b'\x01' + b'\x00'*10)
+    epoch_enc, epoch_mac = encrypt_many(epoch_key, [prefix + b'\x00'*11, prefix + b'\x01' + b'\x00'*10])
     return epoch_enc, epoch_mac
 
 
+def get_epoch_verification(verification_cipher: Encryptor, day: int, epoch: int) -> bytes:
+    """
+    Derive the epoch verification block (epochVER) under an already set-up daily verification key.
+    """
+    return verification_cipher.encrypt(num_to_bytes(day, 4) + num_to_bytes(epoch, 1) + b'\x00'*11)
+
+
+def get_epoch_verifications(key_i_verification: bytes, day: int, epochs: List[int]) -> List[bytes]:
+    """
+    Derive the epoch verification blocks of many epochs of the same day in a single call.
+    """
+    day_prefix = num_to_bytes(day, 4)
+    return encrypt_many(key_i_verification, [day_prefix + num_to_bytes(epoch, 1) + b'\x00'*11 for epoch in epochs])
+
+
 def get_key_i_verification(key_master_verification: bytes, day: int) -> bytes:
-    return hmac(key_master_verification, num_to_bytes(day, 4) + STRINGS['dverif'])[:KEY_LEN]
+    # The user's own master verification key signs every day, so its HMAC context is cached.
+    # Keys of other users must not be kept in the cache, use get_key_i_verifications.
+    return hmac_sha256_cached(key_master_verification, num_to_bytes(day, 4) + STRINGS['dverif'])[:KEY_LEN]
+
+
+def get_key_i_verifications(key_master_verification: bytes, days: List[int]) -> List[bytes]:
+    """
+    Derive the daily verification keys of many days, under an HMAC context which is dropped on return.
+    """
+    hmac_key = HmacKey(key_master_verification)
+    return [hmac_key.digest(num_to_bytes(day, 4) + STRINGS['dverif'])[:KEY_LEN] for day in days]
 
 
 def get_next_day_master_key(prev_master_key: bytes, install_day: bool = False) -> bytes:
@@ -35,3 +65,41 @@ def get_next_day_master_key(prev_master_key: bytes, install_day: bool = False) -
         return hmac(prev_master_key, STRINGS['master0'])[:KEY_LEN]
     else:
         return hmac(prev_master_key, STRINGS['master'])[:KEY_LEN]
+
+
+def expand_day_key(day_key: bytes, commit: bytes, day: int) -> List[bytes]:
+    """
+    Derive the epoch keys of all epochs of a day from the day key (K_day) and the daily commitment key.
+    """
+    day_bytes = num_to_bytes(day, 4)
+    return [get_key_epoch(pre_key, commit, day_bytes, num_to_bytes(epoch, 1))
+            for epoch, pre_key in enumerate(get_pre_epoch_keys(day_key, day))]
+
+
+def get_pre_epoch_keys(day_key: bytes, day: int) -> List[bytes]:
+    """
+    Derive the pre-epoch keys of all epochs of a day, which are all encrypted under the day key, in a single call.
+    """
+    day_bytes = num_to_bytes(day, 4)
+    return encrypt_many(day_key, [day_bytes + num_to_bytes(epoch, 1) + b'\x00'*11 for epoch in range(EPOCHS_IN_DAY)])
+
+
+def expand_day_keys(day_keys: dict, epoch_keys: dict = None) -> dict:
+    """
+    Expand keys published at day granularity (see Server.send_day_keys) into the format of Server.send_keys.
+
+    :param day_keys:    day_keys[day] = [(day key, daily commitment key)].
+    :param epoch_keys:  keys published at epoch granularity, epoch_keys[day][epoch] = [epoch keys].
+    :return:            all keys, result[day][epoch] = [epoch keys] in randomized order.
+    """
+    result = {day: {epoch: list(keys) for epoch, keys in epochs.items()} for day, epochs in (epoch_keys or {}).items()}
+    for day, keys in day_keys.items():
+        for day_key, commit in keys:
+            for epoch, epoch_key in enumerate(expand_day_key(day_key, commit, day)):
+                result.setdefault(day, {}).setdefault(epoch, []).append(epoch_key)
+
+    # randomize the order
+    for epochs in result.values():
+        for keys in epochs.values():
+            keys.sort()
+    return result
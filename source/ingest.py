@@ -0,0 +1,143 @@
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from .keys import UserKey
+from .server import Server
+from .time import EPOCHS_IN_DAY
+
+# Default number of queued user keys which triggers a commit
+INGEST_BATCH_SIZE = 64
+# Number of batches queued before submit waits for the workers
+MAX_QUEUED_BATCHES = 4
+# Default number of seconds an upload waits for its batch to fill before it is committed anyway
+INGEST_MAX_DELAY = 1.0
+
+
+class IngestPipeline:
+    def __init__(self, server: Server, max_workers: int = None, batch_size: int = INGEST_BATCH_SIZE,
+                 use_threads: bool = False, max_delay: float = INGEST_MAX_DELAY):
+        """
+        Queue of uploaded user keys. The epoch keys and verification blocks are derived on a pool of workers, and
+        the results are committed to the server in batches, in upload order (one server version per commit).
+        Queued keys are not visible to the server before they are committed. Commits happen on submit, so a server
+        which may stop receiving uploads should call poll periodically, or the last uploads stay queued.
+
+        :param server:          server to commit the keys to.
+        :param max_workers:     number of workers (default: number of CPUs).
+        :param batch_size:      number of queued user keys which triggers a commit of the finished ones.
+        :param use_threads:     use a thread pool instead of a process pool.
+        :param max_delay:       seconds after which queued keys are committed even if the batch is not full.
+        """
+        self.server = server
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        pool = ThreadPoolExecutor if use_threads else ProcessPoolExecutor
+        self._executor = pool(max_workers=max_workers)
+        # [(submission time, future of the derived keys)] in upload order
+        self._queue = deque()
+
+        self.submitted = 0
+        self.committed = 0
+        # User keys whose derivation raised, they are skipped (the last error is kept for reporting)
+        self.failed = 0
+        self.last_error = None
+        self.committed_keys = 0
+        self.commits = 0
+        self._start = time.monotonic()
+
+    def submit(self, user_key: UserKey) -> None:
+        """
+        Queue a key of an infected user (see Server.receive_user_key).
+
+        :param user_key:
+        :return:
+        """
+        # The worker gets its own copy, so ID and K_ID can be deleted from the caller's key right away
+        job = UserKey(user_key.ID, user_key.K_ID, user_key.preEpoch, user_key.K_masterVER, user_key.preDay)
+        del user_key.K_ID, user_key.ID
+        self._queue.append((time.monotonic(), self._executor.submit(Server._derive_user_key, job)))
+        self.submitted += 1
+        if len(self._queue) >= self.batch_size:
+            # Block the uploads if the workers fall too far behind, so the queue stays bounded
+            self.commit(block=len(self._queue) >= MAX_QUEUED_BATCHES * self.batch_size)
+        else:
+            self.poll()
+
+    def poll(self) -> None:
+        """
+        Commit all queued keys if the oldest of them has waited max_delay, so that a trickle of uploads which
+        never fills a batch is still published.
+        """
+        if len(self._queue) > 0 and time.monotonic() - self._queue[0][0] >= self.max_delay:
+            self.commit(block=True)
+
+    def commit(self, block: bool = False) -> None:
+        """
+        Commit the derived keys at the head of the queue to the server as one batch.
+        User keys whose derivation failed (e.g. malformed uploads) are skipped and counted in self.failed.
+
+        :param block:   wait for all the queued keys to be derived and commit them all.
+        :return:
+        """
+        if block:
+            wait([future for _, future in self._queue])
+        entries = []
+        day_entries = []
+        count = 0
+        while len(self._queue) > 0 and self._queue[0][1].done():
+            future = self._queue.popleft()[1]
+            try:
+                user_entries, user_day_entries = future.result()
+            except Exception as error:
+                self.failed += 1
+                self.last_error = error
+                continue
+            entries.extend(user_entries)
+            day_entries.extend(user_day_entries)
+            count += 1
+        if count == 0:
+            return
+
+        self.server.receive_derived_keys(entries, day_entries)
+        self.committed += count
+        self.committed_keys += len(entries) + EPOCHS_IN_DAY * len(day_entries)
+        self.commits += 1
+
+    def close(self) -> None:
+        """
+        Commit all queued keys and stop the workers.
+        """
+        try:
+            self.commit(block=True)
+        finally:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Number of user keys submitted but not committed yet.
+        """
+        return len(self._queue)
+
+    def stats(self) -> dict:
+        """
+        :return:    counters of the pipeline and its throughput (committed user keys and epoch keys per second).
+        """
+        elapsed = time.monotonic() - self._start
+        return {
+            'submitted': self.submitted,
+            'committed': self.committed,
+            'committed_keys': self.committed_keys,
+            'commits': self.commits,
+            'failed': self.failed,
+            'queue_depth': self.queue_depth,
+            'elapsed': elapsed,
+            'user_keys_per_second': self.committed / elapsed if elapsed > 0 else 0.0,
+            'keys_per_second': self.committed_keys / elapsed if elapsed > 0 else 0.0,
+        }
@@ -1,8 +1,10 @@
 from typing import List, Tuple
 from .crypto import hmac_sha256 as hmac
-from .crypto import encrypt
+from .crypto import Encryptor
 from .bytes_utils import num_to_bytes, STRINGS
-from .derivation_utils import get_key_commit_i, get_key_epoch
+from .time import Time, epoch_ordinal, split_epoch_ordinal
+from .derivation_utils import get_key_commit_i, get_key_epoch, get_key_i_verification, get_epoch_keys
+from .derivation_utils import get_epoch_verification, get_pre_epoch_keys
 
 KEY_LEN = 16
 MESSAGE_LEN = 16
@@ -10,10 +12,11 @@ HMAC_KEY_LEN = 64
 
 
 # Represents a set of keys an infected user sends to the server
-# Keys are stored as tupples: (day, epoch, PreK_epoch)
+# Keys are stored as tupples: (day, epoch, PreK_epoch), and whole days as tupples: (day, K_day)
 class UserKey:
     def __init__(self, user_id: bytes, key_id: bytes,
-                 pre_epochs: List[Tuple[int, int, bytes]], key_master_verification: bytes):
+                 pre_epochs: List[Tuple[int, int, bytes]], key_master_verification: bytes,
+                 pre_days: List[Tuple[int, bytes]] = None):
         """
         User key of infected users. should be sent to the server if an infected user agrees.
 
@@ -21,40 +24,209 @@ class UserKey:
         :param key_id:                      Identification key
         :param pre_epochs:                  cryptographic keys for users to check for contact.
         :param key_master_verification:     key for validating user.
+        :param pre_days:                    day keys, each standing for the pre-epoch keys of all epochs of its day.
         """
         self.ID = user_id
         self.K_ID = key_id
         self.preEpoch = pre_epochs
         self.K_masterVER = key_master_verification
+        self.preDay = [] if pre_days is None else pre_days
+
+
+class DayMaterial:
+    __slots__ = ('i', '_key_master_com', '_key_master_verification', '_verification', '_commit', '_verification_cipher')
+
+    def __init__(self, i: int, key_master_com: bytes, key_master_verification: bytes):
+        """
+        Daily commitment and verification keys, shared by the epoch keys of a day. Derived on first use.
+
+        :param i:                           The corresponding day
+        :param key_master_com:              The master commitment key.
+        :param key_master_verification:     Master verification key for proofing id.
+        """
+        self.i = i
+        self._key_master_com = key_master_com
+        self._key_master_verification = key_master_verification
+        self._verification = None
+        self._commit = None
+        self._verification_cipher = None
+
+    @property
+    def verification(self) -> bytes:
+        if self._verification is None:
+            self._verification = get_key_i_verification(self._key_master_verification, self.i)
+        return self._verification
+
+    @property
+    def commit(self) -> bytes:
+        if self._commit is None:
+            self._commit = get_key_commit_i(self._key_master_com, num_to_bytes(self.i, 4))
+        return self._commit
+
+    # Every epoch of the day encrypts under the verification key, so the cipher is set up once per day.
+    @property
+    def verification_cipher(self) -> Encryptor:
+        if self._verification_cipher is None:
+            self._verification_cipher = Encryptor(self.verification)
+        return self._verification_cipher
 
 
 class DayKey:
+    __slots__ = ('i', 'day', 'material')
+
     def __init__(self, i: int, master_key: bytes, key_master_com: bytes, key_master_verification: bytes):
         """
         Day key to derive epoch keys from.
+        Only the day key itself is derived here, so that the master key of the day can be discarded right away.
 
         :param i:                           The corresponding day
         :param master_key:                  The current day master key. Use get_next_master_key.
         :param key_master_com:              The master commitment key.
         :param key_master_verification:     Master verification key for proofing id.
         """
+        self.i = i
         self.day = hmac(master_key, STRINGS['ddaykey'])[:KEY_LEN]
-        self.verification = hmac(key_master_verification, num_to_bytes(i, 4) + STRINGS['dverif'])[:KEY_LEN]
-        self.commit = get_key_commit_i(key_master_com, num_to_bytes(i, 4))
+        self.material = DayMaterial(i, key_master_com, key_master_verification)
+
+    def epoch_keys(self) -> List['EpochKey']:
+        """
+        Derive the pre-epoch keys of all epochs of the day at once.
+        The epoch keys do not refer to the day key, so deleting an epoch key can not be undone without K_day.
+
+        :return:    the EpochKey of every epoch of the day, in order.
+        """
+        return [EpochKey(self.i, j, pre_key, self.material) for j, pre_key in enumerate(get_pre_epoch_keys(self.day, self.i))]
 
 
 class EpochKey:
-    def __init__(self, i: int, j: int, k_day: DayKey):
+    __slots__ = ('i', 'j', 'preKey', 'material', '_epoch', '_epoch_enc', '_epoch_mac', '_epoch_ver')
+
+    def __init__(self, i: int, j: int, pre_key: bytes, material: DayMaterial):
         """
-        Key for a specific epoch.
+        Key for a specific epoch. The keys other than the pre-epoch key are derived on first use.
 
         :param i:           epoch day.
         :param j:           epoch index
-        :param k_day:       day key.
-        """
-        time_prefix = num_to_bytes(i, 4) + num_to_bytes(j, 1)
-        self.preKey = encrypt(k_day.day, time_prefix + b'\x00'*11)
-        self.epoch = get_key_epoch(self.preKey, k_day.commit, num_to_bytes(i, 4), num_to_bytes(j, 1))
-        self.epochENC = encrypt(self.epoch, time_prefix + b'\x00'*11)
-        self.epochMAC = encrypt(self.epoch, time_prefix + b'\x01' + b'\x00'*10)
-        self.epochVER = encrypt(k_day.verification, time_prefix + b'\x00'*11)
+        :param pre_key:     pre-epoch key (see DayKey.epoch_keys).
+        :param material:    commitment and verification keys of the day.
+        """
+        self.i = i
+        self.j = j
+        self.preKey = pre_key
+        self.material = material
+        self._epoch = None
+        self._epoch_enc = None
+        self._epoch_mac = None
+        self._epoch_ver = None
+
+    @property
+    def epoch(self) -> bytes:
+        if self._epoch is None:
+            self._epoch = get_key_epoch(self.preKey, self.material.commit, num_to_bytes(self.i, 4), num_to_bytes(self.j, 1))
+        return self._epoch
+
+    @property
+    def epochENC(self) -> bytes:
+        if self._epoch_enc is None:
+            self._epoch_enc, self._epoch_mac = get_epoch_keys(self.epoch, self.i, self.j)
+        return self._epoch_enc
+
+    @property
+    def epochMAC(self) -> bytes:
+        if self._epoch_mac is None:
+            self._epoch_enc, self._epoch_mac = get_epoch_keys(self.epoch, self.i, self.j)
+        return self._epoch_mac
+
+    @property
+    def epochVER(self) -> bytes:
+        if self._epoch_ver is None:
+            self._epoch_ver = get_epoch_verification(self.material.verification_cipher, self.i, self.j)
+        return self._epoch_ver
+
+
+class EpochKeyStore:
+    def __init__(self):
+        """
+        Epoch keys of a user, indexed by epoch ordinal (see time.epoch_ordinal).
+        Keys are held in a list covering the epochs from self.first on, so lookups and range deletions
+        are list indexing and slicing.
+        """
+        self.first = 0
+        self._keys = []
+
+    def get(self, ordinal: int) -> EpochKey:
+        """
+        :return:    the key of an epoch ordinal, None if not present.
+        """
+        i = ordinal - self.first
+        if 0 <= i < len(self._keys):
+            return self._keys[i]
+        return None
+
+    def set(self, ordinal: int, epoch_key: EpochKey) -> None:
+        if len(self._keys) == 0:
+            self.first = ordinal
+        if ordinal < self.first:
+            self._keys[:0] = [None] * (self.first - ordinal)
+            self.first = ordinal
+        i = ordinal - self.first
+        if i >= len(self._keys):
+            self._keys.extend([None] * (i + 1 - len(self._keys)))
+        self._keys[i] = epoch_key
+
+    def delete_range(self, start: int, end: int) -> None:
+        """
+        Delete the keys of epoch ordinals start to end (inclusive).
+        """
+        start = max(start - self.first, 0)
+        end = min(end - self.first + 1, len(self._keys))
+        if start < end:
+            self._keys[start:end] = [None] * (end - start)
+        self._trim()
+
+    def delete_before(self, ordinal: int) -> None:
+        """
+        Delete the keys of all epoch ordinals before ordinal.
+        """
+        if ordinal > self.first:
+            del self._keys[:ordinal - self.first]
+            self.first = ordinal
+        self._trim()
+
+    def _trim(self) -> None:
+        while len(self._keys) > 0 and self._keys[-1] is None:
+            self._keys.pop()
+        start = 0
+        while start < len(self._keys) and self._keys[start] is None:
+            start += 1
+        if start > 0:
+            del self._keys[:start]
+            self.first += start
+
+    def ordinals(self) -> List[int]:
+        return [self.first + i for i, epoch_key in enumerate(self._keys) if epoch_key is not None]
+
+    def __len__(self) -> int:
+        return len(self.ordinals())
+
+    def __contains__(self, t) -> bool:
+        return self.get(epoch_ordinal(t.day, t.epoch)) is not None
+
+    def __getitem__(self, t) -> EpochKey:
+        """
+        :param t:   Time of the epoch.
+        """
+        epoch_key = self.get(epoch_ordinal(t.day, t.epoch))
+        if epoch_key is None:
+            raise KeyError(t)
+        return epoch_key
+
+    # Views keyed by Time, like the dictionary this store replaces
+    def keys(self) -> List[Time]:
+        return [Time(*split_epoch_ordinal(ordinal)) for ordinal in self.ordinals()]
+
+    def values(self) -> List[EpochKey]:
+        return [epoch_key for epoch_key in self._keys if epoch_key is not None]
+
+    def items(self) -> List[Tuple[Time, EpochKey]]:
+        return list(zip(self.keys(), self.values()))
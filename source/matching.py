@@ -0,0 +1,384 @@
+from typing import Iterable, Iterator, List, Tuple
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from . import stats
+from .utilities import Match, Contact, ContactDB
+from .bytes_utils import num_to_bytes, xor
+from .keys import MESSAGE_LEN
+from .derivation_utils import get_epoch_keys
+from .crypto import encrypt, encrypt_many
+from .time import T_EPOCH, T_UNIT, JITTER_THRESHOLD, UNITS_IN_EPOCH, RETENTION_DAYS
+from .time import day_to_second, epoch_ordinal, time_to_unit_ordinal, split_unit_ordinal
+
+use_numpy = True
+try:
+    import numpy as np
+except ImportError:
+    use_numpy = False
+
+
+USER_RAND_LEN = 4
+GEOHASH_LEN = 5
+ZERO_PREFIX_LEN = 3
+# Number of units visited around every contact (from contact.time - JITTER_THRESHOLD up to contact.time + JITTER_THRESHOLD)
+UNITS_IN_JITTER_WINDOW = 2 * JITTER_THRESHOLD // T_UNIT + 1
+# Upper bound on the number of bytes XORed at once by the vectorized engine
+MAX_XOR_CELLS = 1 << 22
+# Default number of infected epoch keys whose masks are kept by a MaskCache (about 1.4 KB each, so about 11 MB)
+MASK_CACHE_SIZE = 8192
+
+
+def get_unit_masks(epoch_keys: List[bytes], day: int, epoch: int, unit: int) -> List[Tuple[bytes, bytes]]:
+    """
+    Derive the masks infected users used during a specific unit.
+
+    :param epoch_keys:  infected epoch keys of (day, epoch).
+    :param day:         day of the unit.
+    :param epoch:       epoch of the unit.
+    :param unit:        unit index inside the epoch.
+    :return:            list of (mask, epochMAC), in the order of epoch_keys.
+    """
+    masks = []
+    for epoch_key in epoch_keys:
+        epoch_enc, epoch_mac = get_epoch_keys(epoch_key, day, epoch)
+        masks.append((encrypt(epoch_enc, num_to_bytes(unit, MESSAGE_LEN)), epoch_mac))
+    return masks
+
+
+class MaskCache:
+    def __init__(self, max_keys: int = MASK_CACHE_SIZE, retention_days: int = RETENTION_DAYS):
+        """
+        Derived masks of infected epoch keys, kept between calls to find_crypto_matches.
+        Entries are (epochENC, epochMAC, [mask of every unit of the epoch]), keyed by (day, epoch, epoch key).
+        Entries of days older than retention_days before the latest day seen are dropped.
+        Every call visits the published keys in the same order, so evicting the least recently used entries would
+        evict every entry before its next use once a pass visits more than max_keys keys. Instead, entries are
+        admitted until max_keys are held and kept until their day expires. The entries which are not admitted are
+        kept only while the epochs around theirs are visited, for the other units of their epoch.
+
+        :param max_keys:        maximal number of epoch keys to keep (each takes about 1.4 KB).
+        :param retention_days:  number of days to keep.
+        """
+        self.max_keys = max_keys
+        self.retention_days = retention_days
+        self.latest_day = None
+        self._entries = {}
+        # Entries not admitted, of the epoch ordinals next to self._transient_epoch
+        self._transient = {}
+        self._transient_epoch = None
+        # Number of epoch keys whose masks were found in the cache
+        self.hits = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, epoch_key: bytes, day: int, epoch: int) -> Tuple[bytes, bytes, List[bytes]]:
+        """
+        Get the derived keys and unit masks of an epoch key, deriving them if needed.
+        :return:    (epochENC, epochMAC, [mask of every unit of the epoch]).
+        """
+        entry_key = (day, epoch, bytes(epoch_key))
+        entry = self._entries.get(entry_key)
+        if entry is None:
+            entry = self._transient.get(entry_key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        epoch_enc, epoch_mac = get_epoch_keys(epoch_key, day, epoch)
+        masks = encrypt_many(epoch_enc, [num_to_bytes(unit, MESSAGE_LEN) for unit in range(UNITS_IN_EPOCH)])
+        entry = (epoch_enc, epoch_mac, masks)
+
+        if self.latest_day is None or day > self.latest_day:
+            self.latest_day = day
+            self.expire(day - self.retention_days + 1)
+        if day <= self.latest_day - self.retention_days:
+            return entry
+        if len(self._entries) < self.max_keys:
+            self._entries[entry_key] = entry
+        else:
+            self._keep_transient(entry_key, entry)
+        return entry
+
+    def _keep_transient(self, entry_key: Tuple[int, int, bytes], entry: Tuple[bytes, bytes, List[bytes]]) -> None:
+        # A jitter window spans at most two epochs, so the entries of the epochs next to the current one are kept
+        ordinal = epoch_ordinal(entry_key[0], entry_key[1])
+        if ordinal != self._transient_epoch:
+            self._transient_epoch = ordinal
+            self._transient = {key: value for key, value in self._transient.items()
+                               if abs(epoch_ordinal(key[0], key[1]) - ordinal) <= 1}
+        self._transient[entry_key] = entry
+
+    def get_unit_masks(self, epoch_keys: List[bytes], day: int, epoch: int, unit: int) -> List[Tuple[bytes, bytes]]:
+        """
+        Cached version of get_unit_masks.
+        """
+        masks = []
+        for epoch_key in epoch_keys:
+            _, epoch_mac, unit_masks = self.get(epoch_key, day, epoch)
+            masks.append((unit_masks[unit], epoch_mac))
+        return masks
+
+    def expire(self, day: int) -> None:
+        """
+        Drop all entries of days before day.
+        """
+        expired = [entry_key for entry_key in self._entries.keys() if entry_key[0] < day]
+        for entry_key in expired:
+            del self._entries[entry_key]
+        self._transient = {key: value for key, value in self._transient.items() if key[0] >= day}
+
+
+def is_match(mask: bytes, epoch_mac: bytes, contact: Contact) -> Tuple[bool, bytes, bytes]:
+    ephid = contact.EphID
+    plain = xor(mask, ephid)
+    zeros = plain[:ZERO_PREFIX_LEN]
+    ephid_geohash = plain[ZERO_PREFIX_LEN:ZERO_PREFIX_LEN + GEOHASH_LEN]
+    ephid_user_rand = plain[ZERO_PREFIX_LEN + GEOHASH_LEN:ZERO_PREFIX_LEN + GEOHASH_LEN + USER_RAND_LEN]
+
+    # First three bytes of plaintext are zero
+    if any([x != 0 for x in zeros]):
+        return False, bytes(0), bytes(0)
+
+    x = ephid[:-4] + mask[-4:]
+    y = ephid[-4:]
+    if y == encrypt(epoch_mac, x)[:4]:
+        return True, ephid_geohash, ephid_user_rand
+    return False, bytes(0), bytes(0)
+
+
+def _contact_times(contacts) -> List[int]:
+    return contacts.times if isinstance(contacts, ContactDB) else [contact.time for contact in contacts]
+
+
+def find_crypto_matches_python(contacts: List[Contact], infected_key_database: dict,
+                               mask_cache: MaskCache = None) -> List[Match]:
+    """
+    Check for matching with the infected users.
+
+    :param contacts:                contacts sorted by time (a list or a ContactDB).
+    :param infected_key_database:   keys as sent by the server, infected_key_database[day][epoch] = [epoch keys].
+    :param mask_cache:              cache to take the unit masks from (default: derive them).
+    :return:                        List of matches with the infected users.
+    """
+    return [match for _, match in _find_crypto_matches_python(contacts, infected_key_database, mask_cache)]
+
+
+def _find_crypto_matches_python(contacts: List[Contact], infected_key_database: dict,
+                                mask_cache: MaskCache = None) -> List[Tuple[int, Match]]:
+    """
+    :return:    list of (index of the contact in contacts, match), in the order of find_crypto_matches_python.
+    """
+    matches = []
+    unit_masks = get_unit_masks if mask_cache is None else mask_cache.get_unit_masks
+
+    # unit_keys maps a unit ordinal (see time.unit_ordinal) to a hash index from the first three bytes of a mask
+    # to a list of (mask, epochMAC).
+    # A contact can only match a mask if the first three bytes of the XOR are zero, i.e. if
+    # ephid[:3] == mask[:3], so each contact needs one lookup per unit instead of a scan over all masks.
+    unit_keys = {}
+    # Counters (see stats.py), collected only when instrumentation is enabled
+    instrument = stats.enabled
+    prefix_rejections = mac_checks = 0
+    for contact_index, contact in enumerate(contacts):
+        first_unit = time_to_unit_ordinal(contact.time - JITTER_THRESHOLD)
+        _drop_units_before(unit_keys, first_unit)
+
+        prefix = contact.EphID[:ZERO_PREFIX_LEN]
+        for unit in range(first_unit, first_unit + UNITS_IN_JITTER_WINDOW):
+            index = unit_keys.get(unit)
+            if index is None:
+                index = unit_keys[unit] = _unit_index(infected_key_database, unit_masks, unit)
+
+            candidates = index.get(prefix, ())
+            if instrument:
+                prefix_rejections += len(candidates) == 0
+                mac_checks += len(candidates)
+            for mask, epoch_mac in candidates:
+                match = is_match(mask, epoch_mac, contact)
+                if match[0]:
+                    matches.append((contact_index, Match(contact, match[1], match[2], unit)))
+
+    if instrument:
+        # (contact, unit) pairs without a mask of the same zero prefix
+        stats.count('matching.prefix_rejections', prefix_rejections)
+        stats.count('matching.mac_checks', mac_checks)
+        stats.count('matching.matches', len(matches))
+        stats.count('matching.contacts', len(contacts))
+    return matches
+
+
+def _drop_units_before(unit_keys: dict, first_unit: int) -> None:
+    """
+    Remove all entries of units before the window of a contact (will save memory usage).
+    For it to work we need contacts to be ordered by contact.time.
+    Only the units held are visited, so a long gap between two contacts costs nothing.
+    """
+    start = perf_counter() if stats.enabled else None
+    for unit in [unit for unit in unit_keys.keys() if unit < first_unit]:
+        del unit_keys[unit]
+    if start is not None:
+        stats.add_time('matching.window', perf_counter() - start)
+
+
+def _unit_index(infected_key_database: dict, unit_masks, unit: int) -> dict:
+    """
+    :param unit_masks:  get_unit_masks or MaskCache.get_unit_masks.
+    :param unit:        unit ordinal.
+    :return:            index of the masks of the unit by their zero prefix, index[mask[:3]] = [(mask, epochMAC)].
+    """
+    start = perf_counter() if stats.enabled else None
+    index = {}
+    day, epoch, unit_in_epoch = split_unit_ordinal(unit)
+    epoch_keys = infected_key_database.get(day, {}).get(epoch, [])
+    for mask, epoch_mac in unit_masks(epoch_keys, day, epoch, unit_in_epoch):
+        index.setdefault(mask[:ZERO_PREFIX_LEN], []).append((mask, epoch_mac))
+    if start is not None:
+        stats.add_time('matching.masks', perf_counter() - start)
+    return index
+
+
+def find_crypto_matches_numpy(contacts: List[Contact], infected_key_database: dict,
+                              mask_cache: MaskCache = None) -> List[Match]:
+    """
+    Vectorized version of User.find_crypto_matches.
+    For every unit, the masks of the unit and the EphIDs of the contacts whose jitter window covers it are held
+    as uint8 arrays and XORed in bulk. Only pairs with a zero prefix go through the MAC check.
+
+    :param contacts:                contacts sorted by time (a list or a ContactDB).
+    :param infected_key_database:   keys as sent by the server, infected_key_database[day][epoch] = [epoch keys].
+    :param mask_cache:              cache to take the unit masks from (default: derive them).
+    :return:                        List of matches with the infected users, in the order of User.find_crypto_matches.
+    """
+    return [match for _, match in _find_crypto_matches_numpy(contacts, infected_key_database, mask_cache)]
+
+
+def _find_crypto_matches_numpy(contacts: List[Contact], infected_key_database: dict,
+                               mask_cache: MaskCache = None) -> List[Tuple[int, Match]]:
+    """
+    :return:    list of (index of the contact in contacts, match), in the order of find_crypto_matches_numpy.
+    """
+    assert use_numpy, "The vectorized matching engine requires numpy"
+    if len(contacts) == 0:
+        return []
+
+    if isinstance(contacts, ContactDB):
+        # The columns of the database are read in place
+        times = np.frombuffer(contacts.time_view(), dtype=np.int64)
+        ephids = np.frombuffer(contacts.ephid_view(), dtype=np.uint8).reshape(-1, MESSAGE_LEN)
+    else:
+        times = np.array([contact.time for contact in contacts], dtype=np.int64)
+        ephids = np.frombuffer(b''.join(contact.EphID for contact in contacts), dtype=np.uint8).reshape(-1, MESSAGE_LEN)
+    # first unit (as an absolute unit number) of every contact window
+    first_units = (times - JITTER_THRESHOLD) // T_UNIT
+    units = np.unique(first_units[:, None] + np.arange(UNITS_IN_JITTER_WINDOW)[None, :])
+
+    # (contact index, absolute unit, mask index, Match)
+    found = []
+    for absolute_unit in units.tolist():
+        day, epoch, unit = split_unit_ordinal(absolute_unit)
+        epoch_keys = infected_key_database.get(day, {}).get(epoch, [])
+        if len(epoch_keys) == 0:
+            continue
+
+        if mask_cache is None:
+            unit_masks = get_unit_masks(epoch_keys, day, epoch, unit)
+        else:
+            unit_masks = mask_cache.get_unit_masks(epoch_keys, day, epoch, unit)
+        masks = np.frombuffer(b''.join(mask for mask, _ in unit_masks), dtype=np.uint8).reshape(-1, MESSAGE_LEN)
+        mask_prefixes = masks[None, :, :ZERO_PREFIX_LEN]
+
+        # contacts are sorted, so the contacts whose window covers this unit are a contiguous range
+        low = int(np.searchsorted(first_units, absolute_unit - UNITS_IN_JITTER_WINDOW + 1, side='left'))
+        high = int(np.searchsorted(first_units, absolute_unit, side='right'))
+        step = max(1, MAX_XOR_CELLS // (ZERO_PREFIX_LEN * len(unit_masks)))
+
+        for start in range(low, high, step):
+            end = min(start + step, high)
+            plain_prefixes = ephids[start:end, None, :ZERO_PREFIX_LEN] ^ mask_prefixes
+            candidates = np.nonzero(~plain_prefixes.any(axis=2))
+            for contact_index, mask_index in zip((candidates[0] + start).tolist(), candidates[1].tolist()):
+                mask, epoch_mac = unit_masks[mask_index]
+                match = is_match(mask, epoch_mac, contacts[contact_index])
+                if match[0]:
+                    found.append((contact_index, absolute_unit, mask_index,
+                                  Match(contacts[contact_index], match[1], match[2], absolute_unit)))
+
+    found.sort(key=lambda x: x[:3])
+    return [(x[0], x[3]) for x in found]
+
+
+def stream_crypto_matches(contacts: List[Contact], chunks: Iterable[Tuple[int, int, List[bytes]]],
+                          mask_cache: MaskCache = None) -> Iterator[Match]:
+    """
+    Check for matching with the infected users while reading the key database chunk by chunk.
+    Only the current chunk is held in memory: every (contact, unit) pair depends on the keys of a single epoch,
+    so a chunk is matched against the contacts whose jitter window overlaps its epoch and then dropped.
+
+    :param contacts:        contacts sorted by time (a list or a ContactDB).
+    :param chunks:          iterable of (day, epoch, [epoch keys]), e.g. Server.iter_keys().
+                            An epoch may be split over several chunks.
+    :param mask_cache:      cache to take the unit masks from (default: derive them).
+    :return:                iterator over the matches, chunk after chunk.
+    """
+    times = _contact_times(contacts)
+    for day, epoch, epoch_keys in chunks:
+        epoch_start = epoch_ordinal(day, epoch) * T_EPOCH
+        first = bisect_left(times, epoch_start - JITTER_THRESHOLD)
+        last = bisect_left(times, epoch_start + T_EPOCH + JITTER_THRESHOLD)
+        if first == last:
+            continue
+        for match in find_crypto_matches_python(contacts[first:last], {day: {epoch: epoch_keys}}, mask_cache):
+            yield match
+
+
+def _match_day_shard(contacts: List[Contact], day_keys: dict, use_numpy_engine: bool) -> List[Tuple[int, Match]]:
+    """
+    Worker of find_crypto_matches_parallel.
+    :return:    list of (index of the contact in contacts, match).
+    """
+    engine = _find_crypto_matches_numpy if use_numpy_engine else _find_crypto_matches_python
+    return engine(contacts, day_keys)
+
+
+def find_crypto_matches_parallel(contacts: List[Contact], infected_key_database: dict,
+                                 use_numpy_engine: bool = False, max_workers: int = None) -> List[Match]:
+    """
+    Check for matching with the infected users, one day of the database per task of a process pool.
+    Every task gets only the keys of its day and the contacts whose jitter window overlaps that day.
+    Workers derive their own masks, a MaskCache of the calling process is not used.
+
+    :param contacts:                contacts sorted by time (a list or a ContactDB).
+    :param infected_key_database:   keys as sent by the server, infected_key_database[day][epoch] = [epoch keys].
+    :param use_numpy_engine:        use the vectorized engine inside the workers.
+    :param max_workers:             number of worker processes (default: number of CPUs).
+    :return:                        List of matches with the infected users, in the order of the sequential engines.
+    """
+    times = _contact_times(contacts)
+    shards = []
+    for day in sorted(infected_key_database.keys()):
+        first = bisect_left(times, day_to_second(day) - JITTER_THRESHOLD)
+        last = bisect_left(times, day_to_second(day + 1) + JITTER_THRESHOLD)
+        if first == last:
+            continue
+        day_keys = {day: {epoch: [bytes(key) for key in keys]
+                          for epoch, keys in infected_key_database[day].items()}}
+        shards.append((first, contacts[first:last], day_keys))
+
+    if len(shards) == 0:
+        return []
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(_match_day_shard, [shard[1] for shard in shards], [shard[2] for shard in shards],
+                               [use_numpy_engine] * len(shards))
+        found = []
+        for (first, _, _), shard_matches in zip(shards, results):
+            for i, match in shard_matches:
+                # Workers return copies of the contacts, give back the caller's objects
+                match.contact = contacts[first + i]
+                found.append((first + i, match.infected_unit, len(found), match))
+
+    # A unit belongs to exactly one day, so ordering by contact and then by unit restores the sequential order
+    found.sort(key=lambda x: x[:3])
+    return [x[3] for x in found]
@@ -2,10 +2,15 @@
     for complaints: Ron Asherov
 """
 
+from typing import Iterator, List, Tuple
+from . import stats
 from .keys import UserKey
 from .bytes_utils import num_to_bytes
-from .crypto import encrypt
-from .derivation_utils import get_key_master_com, get_key_commit_i, get_key_epoch, get_key_i_verification
+from .wire import write_key_file
+from .storage import MemoryStore
+from .time import EPOCHS_IN_DAY, RETENTION_DAYS
+from .derivation_utils import get_key_master_com, get_key_commits, get_key_epoch, get_key_i_verifications
+from .derivation_utils import get_epoch_verifications, expand_day_key
 
 USER_RAND_LEN = 4
 
@@ -13,9 +18,26 @@ USER_RAND_LEN = 4
 # note that no identification data is stored on the server.
 # The keys are identified only using the MoH generated TestCode.
 class Server:
-    def __init__(self):
-        # self.epochs[day][epoch] = [randomized list of (epoch key, verification key)]
-        self.epochs = {}
+    def __init__(self, retention_days: int = RETENTION_DAYS, store=None):
+        """
+        Server of the infected users' keys. The keys are stored by day (see storage.py).
+
+        :param retention_days:  number of days to keep keys for (see expire).
+        :param store:           storage backend, MemoryStore (default) or FileStore (see storage.py).
+        """
+        self.retention_days = retention_days
+        self.store = MemoryStore() if store is None else store
+        # Every batch of received user keys gets a new version, and keys of days before oldest_day have expired.
+        # Both are saved in the store, since a batch may leave no records (e.g. all its days expired).
+        # Records are written before the state, so the records may hold a later version.
+        version, self.oldest_day = self.store.load_state()
+        self.version = max(version, self.store.last_version())
+        # Keys uploaded at day granularity: self.day_keys[day] = [(version, day key, daily commitment key)]
+        self.day_keys = {}
+        # Day keys not expanded into the store yet: [(version, day, day key, commitment key, verification key)]
+        self._unexpanded = []
+        # self._expanded[day] = {epoch keys of the store which were expanded from day keys}
+        self._expanded = {}
 
     def receive_user_commit(self, user_commit_id, user_key_id, test_code):
         pass
@@ -27,47 +49,222 @@ class Server:
         :param user_key:
         :return:
         """
+        self.receive_user_keys([user_key])
+
+    def receive_user_keys(self, user_keys: List[UserKey]) -> None:
+        """
+        Receive the keys of many infected users at once. The keys are published as a single version.
+
+        :param user_keys:
+        :return:
+        """
+        entries = []
+        day_entries = []
+        for user_key in user_keys:
+            user_entries, user_day_entries = self._derive_user_key(user_key)
+            entries.extend(user_entries)
+            day_entries.extend(user_day_entries)
+        if stats.enabled:
+            stats.count('server.user_keys', len(user_keys))
+        self.receive_derived_keys(entries, day_entries)
+
+    def receive_derived_keys(self, entries: List[Tuple[int, int, bytes, bytes]],
+                             day_entries: List[Tuple[int, bytes, bytes, bytes]] = ()) -> None:
+        """
+        Store keys already derived by _derive_user_key (e.g. by an IngestPipeline). The keys are published as a
+        single version.
+        Day keys are expanded into epoch keys lazily: all pending day keys are expanded in one batch when the keys
+        are next read, or before keys of a later version are stored.
+        On a persistent store they are expanded before returning, since pending day keys are only held in memory.
+        The day keys themselves are not persisted, after a restart send_day_keys sends their epoch keys instead.
+
+        :param entries:         list of (day, epoch, epoch key, epoch verification).
+        :param day_entries:     list of (day, day key, daily commitment key, daily verification key).
+        :return:
+        """
+        self.version += 1
+        if stats.enabled:
+            stats.count('server.epoch_keys', len(entries))
+            stats.count('server.day_keys', len(day_entries))
+        if self.oldest_day is not None:
+            # Drop keys of expired days
+            entries = [entry for entry in entries if entry[0] >= self.oldest_day]
+            day_entries = [entry for entry in day_entries if entry[0] >= self.oldest_day]
+        if len(entries) > 0:
+            # Versions must reach the store in increasing order
+            self._expand_day_keys()
+            self.store.add(self.version, entries)
+        for day, day_key, commit, verification_key in day_entries:
+            self.day_keys.setdefault(day, []).append((self.version, day_key, commit))
+            self._unexpanded.append((self.version, day, day_key, commit, verification_key))
+        if self.store.persistent:
+            self._expand_day_keys()
+        self.store.save_state(self.version, self.oldest_day)
+
+    def _expand_day_keys(self) -> None:
+        """
+        Expand the pending day keys into epoch keys and verification blocks, and store them with their versions.
+        """
+        versions = {}
+        for version, day, day_key, commit, verification_key in self._unexpanded:
+            epoch_keys = expand_day_key(day_key, commit, day)
+            epoch_vers = get_epoch_verifications(verification_key, day, range(EPOCHS_IN_DAY))
+            versions.setdefault(version, []).extend(
+                (day, epoch, epoch_key, epoch_ver) for epoch, (epoch_key, epoch_ver) in enumerate(zip(epoch_keys, epoch_vers)))
+            self._expanded.setdefault(day, set()).update(epoch_keys)
+        for version in sorted(versions.keys()):
+            self.store.add(version, versions[version])
+        self._unexpanded = []
+
+    def expire(self, current_day: int) -> None:
+        """
+        Drop all the keys, verification keys and indexes of days outside the retention window,
+        and reject later uploads of keys for these days.
+
+        :param current_day:     the current day. Days before current_day - retention_days + 1 expire.
+        :return:
+        """
+        oldest_day = current_day - self.retention_days + 1
+        if self.oldest_day is not None and oldest_day <= self.oldest_day:
+            return
+        self.oldest_day = oldest_day
+        self.store.save_state(self.version, self.oldest_day)
+        self._unexpanded = [entry for entry in self._unexpanded if entry[1] >= oldest_day]
+        for day in [day for day in self.day_keys.keys() if day < oldest_day]:
+            del self.day_keys[day]
+            self._expanded.pop(day, None)
+        for day in [day for day in self.store.days() if day < oldest_day]:
+            self.store.drop_day(day)
+
+    @staticmethod
+    def _derive_user_key(user_key: UserKey) -> Tuple[List[Tuple[int, int, bytes, bytes]],
+                                                     List[Tuple[int, bytes, bytes, bytes]]]:
+        """
+        Derive the epoch keys and verification blocks of an infected user.
+        Day keys are not expanded here, only the material of their day is derived.
+        :return:    (list of (day, epoch, epoch key, epoch verification),
+                     list of (day, day key, daily commitment key, daily verification key)).
+        """
         # TODO get a test code and verify it against ID
         key_com_master = get_key_master_com(user_key.K_ID, user_key.ID)
         # From this point, we will no longer need K_ID nor ID. These values should be deleted.
         del user_key.K_ID, user_key.ID
 
-        key_master_verification = user_key.K_masterVER
-        key_com_daily = {}
-
+        # Everything but the epoch key itself depends only on the day, so derive it once per day
+        pre_epochs_daily = {}
         for day, epoch, k_pre_epoch in user_key.preEpoch:
-            if day not in self.epochs:
-                self.epochs[day] = {}
-            if epoch not in self.epochs[day]:
-                self.epochs[day][epoch] = []
-
-            daily_commit_key = key_com_daily.setdefault(day, get_key_commit_i(key_com_master, num_to_bytes(day, 4)))
-            epoch_key = get_key_epoch(k_pre_epoch, daily_commit_key, num_to_bytes(day, 4), num_to_bytes(epoch, 1))
-            daily_verification_key = get_key_i_verification(key_master_verification, day)
-            epoch_ver = encrypt(daily_verification_key, num_to_bytes(day, 4) + num_to_bytes(epoch, 1) + b'\x00'*11)
+            pre_epochs_daily.setdefault(day, []).append((epoch, k_pre_epoch))
+        days = list(pre_epochs_daily.keys()) + [day for day, _ in user_key.preDay]
+        daily_commit_keys = get_key_commits(key_com_master, [num_to_bytes(day, 4) for day in days])
+        # The uploader's master verification key is not cached beyond this call
+        daily_verification_keys = get_key_i_verifications(user_key.K_masterVER, days)
+        entries = []
 
-            self.epochs[day][epoch].append((epoch_key, epoch_ver))
+        for day, daily_commit_key, daily_verification_key in zip(days, daily_commit_keys[:len(pre_epochs_daily)],
+                                                                 daily_verification_keys):
+            day_bytes = num_to_bytes(day, 4)
+            pre_epochs = pre_epochs_daily[day]
+            epoch_vers = get_epoch_verifications(daily_verification_key, day, [epoch for epoch, _ in pre_epochs])
+            for (epoch, k_pre_epoch), epoch_ver in zip(pre_epochs, epoch_vers):
+                epoch_key = get_key_epoch(k_pre_epoch, daily_commit_key, day_bytes, num_to_bytes(epoch, 1))
+                entries.append((day, epoch, epoch_key, epoch_ver))
 
-            # randomize the order
-            self.epochs[day][epoch] = sorted(self.epochs[day][epoch], key=lambda x: x[0])
+        day_entries = [(day, day_key, daily_commit_key, daily_verification_key)
+                       for (day, day_key), daily_commit_key, daily_verification_key in
+                       zip(user_key.preDay, daily_commit_keys[len(pre_epochs_daily):],
+                           daily_verification_keys[len(pre_epochs_daily):])]
+        return entries, day_entries
 
     def send_keys(self) -> dict:
-        # TODO some kind of delete-old-keys mechanism
         epochs = {}
-        for day in self.epochs.keys():
-            epochs[day] = {}
-            for epoch in self.epochs[day].keys():
-                epochs[day][epoch] = [x[0] for x in self.epochs[day][epoch]]
+        for day, epoch, keys in self.iter_keys():
+            epochs.setdefault(day, {})[epoch] = keys
         return epochs
 
+    def send_keys_since(self, version: int) -> Tuple[int, dict]:
+        """
+        Send only the keys received after a given version.
+
+        :param version:     version returned by the previous call (0 to get all keys).
+        :return:            (current version, keys in the format of send_keys).
+        """
+        self._expand_day_keys()
+        epochs = {}
+        for day in self.store.days():
+            for epoch, epoch_key in self.store.keys_since(day, version):
+                epochs.setdefault(day, {}).setdefault(epoch, []).append(epoch_key)
+
+        # randomize the order
+        for day in epochs.keys():
+            for epoch in epochs[day].keys():
+                epochs[day][epoch].sort()
+        return self.version, epochs
+
+    def iter_keys(self) -> Iterator[Tuple[int, int, List[bytes]]]:
+        """
+        Stream the keys of send_keys, one epoch at a time, in chronological order.
+        :return:    iterator over (day, epoch, [epoch keys]).
+        """
+        self._expand_day_keys()
+        for day in sorted(self.store.days()):
+            for epoch in sorted(self.store.epochs_of(day)):
+                yield day, epoch, self.store.keys(day, epoch)
+
+    def send_day_keys(self) -> Tuple[dict, dict]:
+        """
+        Send the keys at day granularity: every day key uploaded to this server is sent with its daily commitment
+        key instead of its EPOCHS_IN_DAY epoch keys, and clients expand them (see derivation_utils.expand_day_keys).
+        Note that a day key links the epochs of its day to each other.
+
+        :return:    (day_keys[day] = [(day key, daily commitment key)] in randomized order,
+                     the other keys in the format of send_keys).
+        """
+        day_keys = {day: sorted((day_key, commit) for _, day_key, commit in keys) for day, keys in self.day_keys.items()}
+        epochs = {}
+        for day, epoch, keys in self.iter_keys():
+            expanded = self._expanded.get(day, ())
+            keys = [key for key in keys if key not in expanded]
+            if len(keys) > 0:
+                epochs.setdefault(day, {})[epoch] = keys
+        return day_keys, epochs
+
+    def write_keys(self, path: str) -> None:
+        """
+        Write the keys of send_keys in the binary key file format (see wire.py).
+        Clients can memory map the file with wire.KeyFile.open and match against it directly.
+
+        :param path:    file to write.
+        """
+        write_key_file(path, self.iter_keys())
+
     def verify_contact(self, day: int, epoch: int, proof: bytes):
         """
 
-        :note           if proof is correct, self.epochs[day][epoch] should contain a tuple (epoch_key, epoch_ver)
+        :note           if proof is correct, the store should contain for (day, epoch) a tuple (epoch_key, epoch_ver)
                         such that epoch_ver's first four bytes are proof
         :param day:
         :param epoch:
         :param proof:
         :return:
         """
-        return any([x[1][:USER_RAND_LEN] == proof for x in self.epochs.get(day, {}).get(epoch, [])])
+        self._expand_day_keys()
+        verified = self.store.has_proof(day, epoch, proof)
+        if stats.enabled:
+            stats.count('server.verify_contact')
+            stats.count('server.verified', int(verified))
+        return verified
+
+    def verify_contacts(self, claims: List[Tuple[int, int, bytes]]) -> List[bool]:
+        """
+        Verify many contacts at once.
+
+        :param claims:  list of (day, epoch, proof), as given to verify_contact.
+        :return:        list of the verify_contact results, in the order of claims.
+        """
+        self._expand_day_keys()
+        has_proof = self.store.has_proof
+        results = [has_proof(day, epoch, proof) for day, epoch, proof in claims]
+        if stats.enabled:
+            stats.count('server.verify_contact', len(results))
+            stats.count('server.verified', sum(results))
+        return results
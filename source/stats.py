@@ -0,0 +1,90 @@
+"""
+Opt-in instrumentation of the hot paths: crypto operation counters, matching stage timers and server counters.
+Instrumented code checks the module flag `enabled` before doing anything, so it costs a single attribute
+lookup while disabled.
+
+    stats.enable()
+    user.find_crypto_matches(keys)
+    print(stats.STATS.to_dict())
+"""
+
+import tracemalloc
+from typing import Callable
+
+enabled = False
+
+
+class Stats:
+    def __init__(self):
+        """
+        Collected counters (number of events) and timers (total seconds), by name.
+        Snapshots are (label, tracemalloc snapshot), taken only while memory is traced.
+        """
+        self.counters = {}
+        self.timers = {}
+        self.snapshots = []
+
+    def reset(self) -> None:
+        self.counters = {}
+        self.timers = {}
+        self.snapshots = []
+
+    def to_dict(self) -> dict:
+        return {'counters': dict(self.counters), 'timers': dict(self.timers)}
+
+
+STATS = Stats()
+_hook = None
+# tracemalloc was started by enable
+_tracing = False
+
+
+def enable(trace_memory: bool = False, hook: Callable[[str, float], None] = None) -> Stats:
+    """
+    Start collecting into STATS (which is reset).
+
+    :param trace_memory:    trace memory allocations with tracemalloc, so that snapshot takes snapshots.
+    :param hook:            called as hook(name, value) on every counted event (value is the count)
+                            and every timed stage (value is the duration in seconds).
+    :return:                STATS.
+    """
+    global enabled, _hook, _tracing
+    STATS.reset()
+    _hook = hook
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _tracing = True
+    enabled = True
+    return STATS
+
+
+def disable() -> None:
+    """
+    Stop collecting. STATS keeps the collected values.
+    """
+    global enabled, _hook, _tracing
+    enabled = False
+    _hook = None
+    if _tracing:
+        tracemalloc.stop()
+        _tracing = False
+
+
+def count(name: str, n: int = 1) -> None:
+    STATS.counters[name] = STATS.counters.get(name, 0) + n
+    if _hook is not None:
+        _hook(name, n)
+
+
+def add_time(name: str, seconds: float) -> None:
+    STATS.timers[name] = STATS.timers.get(name, 0.0) + seconds
+    if _hook is not None:
+        _hook(name, seconds)
+
+
+def snapshot(label: str) -> None:
+    """
+    Take a tracemalloc snapshot, if memory is traced (see enable).
+    """
+    if tracemalloc.is_tracing():
+        STATS.snapshots.append((label, tracemalloc.take_snapshot()))
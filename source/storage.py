@@ -0,0 +1,293 @@
+"""
+Storage backends of the server.
+Both backends keep the keys organized by day, so that a whole day is dropped at once when it expires.
+"""
+
+import os
+import mmap
+import struct
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, List, Tuple
+from .time import EPOCHS_IN_DAY
+
+USER_RAND_LEN = 4
+# version, epoch, epoch key, epoch verification
+RECORD = struct.Struct('<IB3x16s16s')
+VERSION = struct.Struct('<I')
+KEY_OFFSET = 8
+KEY_LEN = 16
+DAY_FILE_SUFFIX = '.keys'
+# version, oldest day is set, oldest day (see FileStore.save_state)
+STATE = struct.Struct('<I?3xi')
+STATE_FILE = 'server.state'
+
+
+class MemoryStore:
+    # The keys do not survive a restart of the server
+    persistent = False
+
+    def __init__(self):
+        """
+        Server storage in process memory.
+        """
+        # self.epochs[day][epoch] = [randomized list of (epoch key, verification key)]
+        self.epochs = {}
+        # self.history[day] = [(version, epoch, epoch key)], in increasing version order
+        self.history = {}
+        # self.proofs[day][epoch] = {first USER_RAND_LEN bytes of a verification key: [(epoch key, verification key)]}
+        self.proofs = {}
+        # self._unsorted[day] = {epochs of day whose order was not randomized yet}
+        self._unsorted = {}
+        self._state = (0, None)
+
+    def add(self, version: int, entries: List[Tuple[int, int, bytes, bytes]]) -> None:
+        """
+        Store a batch of keys.
+
+        :param version:     version of the batch, larger than the versions of all stored batches.
+        :param entries:     list of (day, epoch, epoch key, epoch verification).
+        """
+        for day, epoch, epoch_key, epoch_ver in entries:
+            if day not in self.epochs:
+                self.epochs[day] = {}
+            if epoch not in self.epochs[day]:
+                self.epochs[day][epoch] = []
+            self.epochs[day][epoch].append((epoch_key, epoch_ver))
+            self.proofs.setdefault(day, {}).setdefault(epoch, {}).setdefault(
+                epoch_ver[:USER_RAND_LEN], []).append((epoch_key, epoch_ver))
+            # The order is randomized once, when the keys are read
+            self._unsorted.setdefault(day, set()).add(epoch)
+            self.history.setdefault(day, []).append((version, epoch, epoch_key))
+
+    def days(self) -> List[int]:
+        return list(self.epochs.keys())
+
+    def epochs_of(self, day: int) -> List[int]:
+        return list(self.epochs.get(day, {}).keys())
+
+    def keys(self, day: int, epoch: int) -> List[bytes]:
+        """
+        :return:    the epoch keys of (day, epoch), in randomized order.
+        """
+        if epoch in self._unsorted.get(day, ()):
+            self.epochs[day][epoch].sort(key=lambda x: x[0])
+            self._unsorted[day].discard(epoch)
+        return [x[0] for x in self.epochs.get(day, {}).get(epoch, [])]
+
+    def keys_since(self, day: int, version: int) -> List[Tuple[int, bytes]]:
+        """
+        :return:    list of (epoch, epoch key) of day stored with a version larger than version.
+        """
+        history = self.history.get(day, [])
+        # (version, EPOCHS_IN_DAY) is above all entries of version and below all entries of later versions
+        return [(epoch, epoch_key) for _, epoch, epoch_key in history[bisect_right(history, (version, EPOCHS_IN_DAY)):]]
+
+    def has_proof(self, day: int, epoch: int, proof: bytes) -> bool:
+        return bytes(proof) in self.proofs.get(day, {}).get(epoch, {})
+
+    def last_version(self) -> int:
+        return max([history[-1][0] for history in self.history.values()], default=0)
+
+    def save_state(self, version: int, oldest_day: int) -> None:
+        self._state = (version, oldest_day)
+
+    def load_state(self) -> Tuple[int, int]:
+        """
+        :return:    (version, oldest day) last saved by save_state, (0, None) if never saved.
+        """
+        return self._state
+
+    def drop_day(self, day: int) -> None:
+        self.epochs.pop(day, None)
+        self.history.pop(day, None)
+        self.proofs.pop(day, None)
+        self._unsorted.pop(day, None)
+
+    def close(self) -> None:
+        pass
+
+
+class FileStore:
+    # The keys survive a restart of the server
+    persistent = True
+
+    def __init__(self, directory: str):
+        """
+        Server storage in append-only files, one file per day, memory mapped for reading.
+        A file holds fixed width records (see RECORD) in increasing version order.
+        Only small per-epoch indexes of the days in use are kept in memory.
+
+        :param directory:   directory of the day files. Existing files are reopened.
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # self._maps[day] = memory map of the day file (None if it has to be mapped again)
+        self._maps = {}
+        # self._records[day][epoch] = array of the record numbers of epoch
+        self._records = {}
+        # self._proofs[day][epoch] = sorted array of the first USER_RAND_LEN bytes of the verification keys
+        self._proofs = {}
+
+        for name in os.listdir(directory):
+            if name.endswith(DAY_FILE_SUFFIX):
+                day = int(name[:-len(DAY_FILE_SUFFIX)])
+                self._truncate(day)
+                self._maps[day] = None
+                self._map(day)
+
+    def _path(self, day: int) -> str:
+        return os.path.join(self.directory, '{}{}'.format(day, DAY_FILE_SUFFIX))
+
+    def _truncate(self, day: int) -> int:
+        """
+        Drop a partial record left at the end of a day file by an interrupted append, so that the following
+        records are appended at record boundaries.
+        :return:    the number of records in the file.
+        """
+        path = self._path(day)
+        if not os.path.exists(path):
+            return 0
+        size = os.path.getsize(path)
+        if size % RECORD.size != 0:
+            os.truncate(path, size - size % RECORD.size)
+        return size // RECORD.size
+
+    def _map(self, day: int):
+        if self._maps[day] is None and os.path.getsize(self._path(day)) > 0:
+            with open(self._path(day), 'rb') as f:
+                self._maps[day] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._maps[day]
+
+    def _count(self, day: int) -> int:
+        mapped = self._map(day)
+        return 0 if mapped is None else len(mapped) // RECORD.size
+
+    def _epoch_records(self, day: int) -> Dict[int, array]:
+        if day not in self._records:
+            records = {}
+            mapped = self._map(day)
+            for i in range(self._count(day)):
+                records.setdefault(mapped[i * RECORD.size + VERSION.size], array('L')).append(i)
+            self._records[day] = records
+        return self._records[day]
+
+    def _epoch_proofs(self, day: int, epoch: int) -> array:
+        if epoch not in self._proofs.setdefault(day, {}):
+            mapped = self._map(day)
+            proofs = [int.from_bytes(RECORD.unpack_from(mapped, i * RECORD.size)[3][:USER_RAND_LEN], 'little')
+                      for i in self._epoch_records(day).get(epoch, ())]
+            self._proofs[day][epoch] = array('L', sorted(proofs))
+        return self._proofs[day][epoch]
+
+    def add(self, version: int, entries: List[Tuple[int, int, bytes, bytes]]) -> None:
+        """
+        Append a batch of keys to the day files.
+
+        :param version:     version of the batch, larger than the versions of all stored batches.
+        :param entries:     list of (day, epoch, epoch key, epoch verification).
+        """
+        by_day = {}
+        for day, epoch, epoch_key, epoch_ver in entries:
+            by_day.setdefault(day, []).append((epoch, epoch_key, epoch_ver))
+
+        for day, day_entries in by_day.items():
+            if self._maps.get(day) is not None:
+                # The file grows, it is mapped again on the next read
+                self._maps[day].close()
+            self._maps[day] = None
+            first = self._truncate(day)
+
+            with open(self._path(day), 'ab') as f:
+                f.write(b''.join(RECORD.pack(version, epoch, epoch_key, epoch_ver)
+                                 for epoch, epoch_key, epoch_ver in day_entries))
+
+            # Keep the indexes which are already built up to date
+            if day in self._records:
+                for i, (epoch, _, _) in enumerate(day_entries):
+                    self._records[day].setdefault(epoch, array('L')).append(first + i)
+            for epoch, _, epoch_ver in day_entries:
+                if epoch in self._proofs.get(day, {}):
+                    insort(self._proofs[day][epoch], int.from_bytes(epoch_ver[:USER_RAND_LEN], 'little'))
+
+    def days(self) -> List[int]:
+        return [day for day in self._maps.keys() if self._count(day) > 0]
+
+    def epochs_of(self, day: int) -> List[int]:
+        return list(self._epoch_records(day).keys()) if day in self._maps else []
+
+    def keys(self, day: int, epoch: int) -> List[bytes]:
+        """
+        :return:    the epoch keys of (day, epoch), in randomized order.
+        """
+        if day not in self._maps:
+            return []
+        mapped = self._map(day)
+        offsets = [i * RECORD.size + KEY_OFFSET for i in self._epoch_records(day).get(epoch, ())]
+        return sorted(mapped[offset:offset + KEY_LEN] for offset in offsets)
+
+    def keys_since(self, day: int, version: int) -> List[Tuple[int, bytes]]:
+        """
+        :return:    list of (epoch, epoch key) of day stored with a version larger than version.
+        """
+        if day not in self._maps:
+            return []
+        mapped = self._map(day)
+        # Records are in increasing version order, find the first one above version
+        low, high = 0, self._count(day)
+        while low < high:
+            middle = (low + high) // 2
+            if VERSION.unpack_from(mapped, middle * RECORD.size)[0] <= version:
+                low = middle + 1
+            else:
+                high = middle
+        return [RECORD.unpack_from(mapped, i * RECORD.size)[1:3] for i in range(low, self._count(day))]
+
+    def has_proof(self, day: int, epoch: int, proof: bytes) -> bool:
+        if day not in self._maps or len(proof) != USER_RAND_LEN:
+            return False
+        proofs = self._epoch_proofs(day, epoch)
+        value = int.from_bytes(proof, 'little')
+        i = bisect_left(proofs, value)
+        return i < len(proofs) and proofs[i] == value
+
+    def last_version(self) -> int:
+        versions = [VERSION.unpack_from(self._map(day), (self._count(day) - 1) * RECORD.size)[0]
+                    for day in self.days()]
+        return max(versions, default=0)
+
+    def save_state(self, version: int, oldest_day: int) -> None:
+        """
+        Save the server counters which are not implied by the records (see STATE), replacing the state file at once.
+        """
+        path = os.path.join(self.directory, STATE_FILE)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(STATE.pack(version, oldest_day is not None, 0 if oldest_day is None else oldest_day))
+        os.replace(path + '.tmp', path)
+
+    def load_state(self) -> Tuple[int, int]:
+        """
+        :return:    (version, oldest day) last saved by save_state, (0, None) if never saved.
+        """
+        path = os.path.join(self.directory, STATE_FILE)
+        if not os.path.exists(path):
+            return 0, None
+        with open(path, 'rb') as f:
+            version, has_oldest_day, oldest_day = STATE.unpack(f.read(STATE.size))
+        return version, oldest_day if has_oldest_day else None
+
+    def drop_day(self, day: int) -> None:
+        if day not in self._maps:
+            return
+        if self._maps[day] is not None:
+            self._maps[day].close()
+        del self._maps[day]
+        self._records.pop(day, None)
+        self._proofs.pop(day, None)
+        os.remove(self._path(day))
+
+    def close(self) -> None:
+        for day, mapped in self._maps.items():
+            if mapped is not None:
+                mapped.close()
+            self._maps[day] = None
@@ -1,4 +1,5 @@
 from __future__ import annotations
+from typing import Tuple
 
 
 # All time constants are in seconds
@@ -7,16 +8,56 @@ T_DAY = 24*60*60
 T_EPOCH = 60 * 60
 T_UNIT = 5 * 60
 UNITS_IN_EPOCH = T_EPOCH // T_UNIT
+UNITS_IN_DAY = T_DAY // T_UNIT
 JITTER_THRESHOLD = 10 * 60
 EPOCHS_IN_DAY = T_DAY // T_EPOCH
 T_WINDOW = 5 * 60
 MAX_CONTACTS_IN_WINDOW = 1000
+# Keys and contacts older than this many days are no longer relevant
+RETENTION_DAYS = 14
 
 
 def day_to_second(day: int) -> int:
     return T_DAY * day
 
 
+# Ordinals number the epochs (or units) since the unix epoch, so a time is a single integer in hot loops.
+def epoch_ordinal(day: int, epoch: int) -> int:
+    return day * EPOCHS_IN_DAY + epoch
+
+
+def unit_ordinal(day: int, epoch: int, unit: int) -> int:
+    return (day * EPOCHS_IN_DAY + epoch) * UNITS_IN_EPOCH + unit
+
+
+def time_to_day(unix_time: int) -> int:
+    return unix_time // T_DAY
+
+
+def time_to_epoch_ordinal(unix_time: int) -> int:
+    return unix_time // T_EPOCH
+
+
+def time_to_unit_ordinal(unix_time: int) -> int:
+    return unix_time // T_UNIT
+
+
+def split_epoch_ordinal(ordinal: int) -> Tuple[int, int]:
+    """
+    :return:    (day, epoch) of an epoch ordinal.
+    """
+    return divmod(ordinal, EPOCHS_IN_DAY)
+
+
+def split_unit_ordinal(ordinal: int) -> Tuple[int, int, int]:
+    """
+    :return:    (day, epoch, unit index inside the epoch) of a unit ordinal.
+    """
+    epoch, unit = divmod(ordinal, UNITS_IN_EPOCH)
+    day, epoch = divmod(epoch, EPOCHS_IN_DAY)
+    return day, epoch, unit
+
+
 class Time:
     def __init__(self, unix_time: int, epoch: int = None):
         if epoch is None:
@@ -31,6 +72,12 @@ class Time:
     def get_units(self) -> int:
         return (self.time - self.day*T_DAY - self.epoch * T_EPOCH) // T_UNIT
 
+    def get_epoch_ordinal(self) -> int:
+        return epoch_ordinal(self.day, self.epoch)
+
+    def get_unit_ordinal(self) -> int:
+        return time_to_unit_ordinal(self.time)
+
     def get_next(self) -> Time:
         if self.epoch == EPOCHS_IN_DAY-1:
             return Time(self.day+1, 0)
@@ -2,30 +2,52 @@
     for complaints: Ron Asherov
 """
 
-from typing import List, Tuple
-from .utilities import Match, Contact
+from typing import Iterable, Iterator, List, Tuple
+from bisect import bisect_right
+from collections import OrderedDict
+from . import stats
+from .utilities import Match, Contact, ContactDB
 from .bytes_utils import num_to_bytes, xor, STRINGS
-from .keys import UserKey, DayKey, EpochKey, KEY_LEN, MESSAGE_LEN
-from .derivation_utils import get_key_master_com, get_epoch_keys, get_next_day_master_key
-from .crypto import encrypt
-from .crypto import hmac_sha256 as hmac
-from .time import Time, T_UNIT, JITTER_THRESHOLD, EPOCHS_IN_DAY, MAX_CONTACTS_IN_WINDOW, T_WINDOW
+from .keys import UserKey, DayKey, EpochKeyStore, KEY_LEN, MESSAGE_LEN
+from .derivation_utils import get_key_master_com, get_next_day_master_key
+from .matching import MaskCache, is_match, find_crypto_matches_python, find_crypto_matches_numpy
+from .matching import find_crypto_matches_parallel, stream_crypto_matches
+from .crypto import encrypt, encrypt_many
+from .crypto import HmacKey
+from .time import JITTER_THRESHOLD, EPOCHS_IN_DAY, UNITS_IN_EPOCH, UNITS_IN_DAY, MAX_CONTACTS_IN_WINDOW, T_WINDOW
+from .time import T_UNIT, day_to_second
+from .time import epoch_ordinal, time_to_day, time_to_epoch_ordinal, time_to_unit_ordinal, split_epoch_ordinal
 
 
 USER_RAND_LEN = 4
 GEOHASH_LEN = 5
+# Number of days whose ephemeral id schedule is kept (see get_scheduled_ephemeral_id)
+EPHID_SCHEDULE_DAYS = 2
 
 
 class User:
     def __init__(self, user_id: bytes, master_key: bytes, init_time: int):
         self.user_id = user_id[:]
 
-        self.K_id = hmac(master_key, STRINGS['id'])[:KEY_LEN]
+        # Not cached: the master key must not outlive its use (see HmacCache)
+        master_hmac = HmacKey(master_key)
+        self.K_id = master_hmac.digest(STRINGS['id'])[:KEY_LEN]
         self.K_master_com = get_key_master_com(self.K_id, self.user_id)
-        self.K_master_ver = hmac(master_key, STRINGS['verifkey'])[:KEY_LEN]
-        self.epoch_keys = {}
-        self.contacts = []
-        self.curr_day = Time(init_time).day
+        self.K_master_ver = master_hmac.digest(STRINGS['verifkey'])[:KEY_LEN]
+        self.epoch_keys = EpochKeyStore()
+        # self.day_keys[day] = K_day, kept only while all epoch keys of the day are present
+        self.day_keys = {}
+        self.contacts = ContactDB()
+        # Masks of infected keys seen in previous calls to find_crypto_matches
+        self.mask_cache = MaskCache()
+        # Checkpoint of poll_crypto_matches: the last key version matched, the keys which may still match
+        # contacts stored later, and the number of contacts added to self.contacts at the last poll.
+        self.keys_version = 0
+        self.pending_keys = {}
+        self.checked_contacts = 0
+        # self.ephid_schedule[day] = (geohash, first unit of the day, [ephemeral ids of the units from that unit on])
+        self.ephid_schedule = OrderedDict()
+        self.curr_day = time_to_day(init_time)
         self.curr_day_master_key = get_next_day_master_key(master_key, install_day=True)
         self._get_epoch_keys(self.curr_day)
 
@@ -41,11 +63,8 @@ class User:
 
         :return:
         """
-        past = Time(past_time)
-        future = Time(future_time)
-
-        self._get_epoch_keys(future.day)
-        self.delete_history(past.time)
+        self._get_epoch_keys(time_to_day(future_time))
+        self.delete_history(past_time)
 
     def generate_ephemeral_id(self, time: int, geo_hash: bytes) -> bytes:
         """
@@ -57,10 +76,9 @@ class User:
                             Raises an error if epoch keys are not present.
         """
         assert len(geo_hash) == GEOHASH_LEN
-        t = Time(time)
-        assert t in self.epoch_keys.keys(), "Epoch key is not present"
-        time_unit_s = t.get_units()
-        epoch_key = self.epoch_keys[t]
+        epoch_key = self.epoch_keys.get(time_to_epoch_ordinal(time))
+        assert epoch_key is not None, "Epoch key is not present"
+        time_unit_s = time_to_unit_ordinal(time) % UNITS_IN_EPOCH
 
         mask = encrypt(epoch_key.epochENC, num_to_bytes(time_unit_s, MESSAGE_LEN))
         user_rand = epoch_key.epochVER[:USER_RAND_LEN]
@@ -69,55 +87,131 @@ class User:
         c_ijs = xor(plain, mask)
         return c_ijs[:12] + encrypt(epoch_key.epochMAC, c_ijs)[:4]
 
-    def find_crypto_matches(self, infected_key_database: dict) -> List[Match]:
+    def generate_ephemeral_ids(self, day: int, geo_hashes: List[Tuple[int, bytes]]) -> List[bytes]:
+        """
+        Generate the ephemeral ids of every unit of a day at once, with one batch of encryptions per epoch key.
+
+        :param day:         day to generate the ephemeral ids of.
+        :param geo_hashes:  location timeline of the day: list of (time, geohash) sorted by time. A unit uses the
+                            geohash of the last entry at or before its start (the first one before that).
+        :return:            list of the UNITS_IN_DAY ephemeral ids of the day, the id of (epoch, unit) at
+                            epoch * UNITS_IN_EPOCH + unit. Each is the result of generate_ephemeral_id,
+                            or None if the key of its epoch is not present (e.g. deleted by delete_my_keys).
+        """
+        assert len(geo_hashes) > 0
+        times = [time for time, _ in geo_hashes]
+        day_start = day_to_second(day)
+        unit_geo_hashes = [geo_hashes[max(bisect_right(times, day_start + unit * T_UNIT) - 1, 0)][1]
+                           for unit in range(UNITS_IN_DAY)]
+        return self._generate_ephemeral_ids(day, 0, unit_geo_hashes)
+
+    def get_scheduled_ephemeral_id(self, time: int, geo_hash: bytes) -> bytes:
+        """
+        Cached version of generate_ephemeral_id for advertising.
+        The ids of all the remaining units of the day are generated at once for the current location, so the
+        following calls are table lookups until the location changes.
+
+        :param time:        current time.
+        :param geo_hash:    current location.
+        :return:            The ephemeral id.
+                            Raises an error if the epoch key is not present.
+        """
+        day = time_to_day(time)
+        unit = time_to_unit_ordinal(time) - day * UNITS_IN_DAY
+        schedule = self.ephid_schedule.get(day)
+        if schedule is None or schedule[0] != geo_hash or unit < schedule[1]:
+            schedule = (geo_hash, unit, self._generate_ephemeral_ids(day, unit, [geo_hash] * (UNITS_IN_DAY - unit)))
+            self.ephid_schedule[day] = schedule
+            while len(self.ephid_schedule) > EPHID_SCHEDULE_DAYS:
+                self.ephid_schedule.popitem(last=False)
+        self.ephid_schedule.move_to_end(day)
+        ephid = schedule[2][unit - schedule[1]]
+        assert ephid is not None, "Epoch key is not present"
+        return ephid
+
+    def _generate_ephemeral_ids(self, day: int, first_unit: int, geo_hashes: List[bytes]) -> List[bytes]:
+        """
+        :param first_unit:  unit of the day (0 to UNITS_IN_DAY - 1) to start from.
+        :param geo_hashes:  geohash of every unit from first_unit to the end of the day.
+        :return:            the ephemeral ids of the units from first_unit to the end of the day,
+                            None for the units of epochs whose key is not present.
+        """
+        assert all(len(geo_hash) == GEOHASH_LEN for geo_hash in geo_hashes)
+        ephids = []
+        for epoch in range(first_unit // UNITS_IN_EPOCH, EPOCHS_IN_DAY):
+            epoch_key = self.epoch_keys.get(epoch_ordinal(day, epoch))
+            units = range(max(first_unit - epoch * UNITS_IN_EPOCH, 0), UNITS_IN_EPOCH)
+            if epoch_key is None:
+                ephids.extend([None] * len(units))
+                continue
+            masks = encrypt_many(epoch_key.epochENC, [num_to_bytes(unit, MESSAGE_LEN) for unit in units])
+            user_rand = epoch_key.epochVER[:USER_RAND_LEN]
+
+            c_ijs = [xor(b'\x00'*3 + geo_hashes[epoch * UNITS_IN_EPOCH + unit - first_unit] + user_rand + b'\x00'*4, mask)
+                     for unit, mask in zip(units, masks)]
+            macs = encrypt_many(epoch_key.epochMAC, c_ijs)
+            ephids.extend(c_ij[:12] + mac[:4] for c_ij, mac in zip(c_ijs, macs))
+        return ephids
+
+    def find_crypto_matches(self, infected_key_database: dict, use_numpy: bool = False,
+                            parallel: bool = False, max_workers: int = None) -> List[Match]:
         """
         Check for matching with the infected user.
         :param infected_key_database:
+        :param use_numpy:       use the vectorized matching engine (requires numpy). Returns the same matches.
+        :param parallel:        split the matching by day over a process pool. Returns the same matches.
+        :param max_workers:     number of worker processes when parallel (default: number of CPUs).
         :return: List of matches with the infected user.
         """
-        matches = []
-
-        # Make sure the contacts are sorted so as to make the sliding window work properly
-        self.contacts = sorted(self.contacts, key=lambda c: c.time)
-
-        # domain is a time up to units (actually a string "day-epoch-unit")
-        # and its range is a list of (mask, epochMAC)
-        unit_keys = {}
-        earliest_time = None
-        for contact in self.contacts:
-            time = contact.time - JITTER_THRESHOLD
-
-            # Remove all entries unit_keys[t] for t < time (will save memory usage)
-            # For it to work we need self.contact to be ordered by contact.time
-            if earliest_time is not None:
-                while earliest_time < time:
-                    t_dict_key = Time(earliest_time).str_with_units()
-                    if t_dict_key in unit_keys.keys():
-                        del unit_keys[t_dict_key]
-                    earliest_time += T_UNIT
-            else:
-                earliest_time = time
-
-            while time <= contact.time + JITTER_THRESHOLD:
-                t = Time(time)
-                t_key = t.str_with_units()
-                unit = t.get_units()
-                time += T_UNIT
-
-                if t_key not in unit_keys:
-                    unit_keys[t_key] = []
-                    for epoch_key in infected_key_database.get(t.day, {}).get(t.epoch, []):
-                        epoch_enc, epoch_mac = get_epoch_keys(epoch_key, t.day, t.epoch)
-                        mask = encrypt(epoch_enc, num_to_bytes(unit, MESSAGE_LEN))
-                        unit_keys[t_key].append((mask, epoch_mac))
-
-                for mask, epoch_mac in unit_keys[t_key]:
-                    match = self._is_match(mask, epoch_mac, contact)
-                    if match[0]:
-                        matches.append(Match(contact, match[1], match[2], t, unit))
+        # The contacts are kept sorted by time, as the sliding window requires
+        if parallel:
+            matches = find_crypto_matches_parallel(self.contacts, infected_key_database, use_numpy, max_workers)
+        elif use_numpy:
+            matches = find_crypto_matches_numpy(self.contacts, infected_key_database, self.mask_cache)
+        else:
+            matches = find_crypto_matches_python(self.contacts, infected_key_database, self.mask_cache)
+        if stats.enabled:
+            stats.snapshot('find_crypto_matches')
+        return matches
+
+    def poll_crypto_matches(self, version: int, new_keys: dict) -> List[Match]:
+        """
+        Check for matching against the keys published since the last poll (see Server.send_keys_since).
+        New keys are matched against all contacts. Contacts stored since the last poll are matched against the
+        previously polled keys which may still match them, i.e. keys of epochs that end after the earliest time a
+        new contact's jitter window can reach.
+
+        :param version:     version of the new keys, as returned by Server.send_keys_since(self.keys_version).
+        :param new_keys:    keys published since self.keys_version.
+        :return:            List of new matches with the infected users.
+        """
+        matches = find_crypto_matches_python(self.contacts, new_keys, self.mask_cache)
+        if self.contacts.added > self.checked_contacts and len(self.pending_keys) > 0:
+            unchecked_contacts = self.contacts.added_since(self.checked_contacts)
+            matches += find_crypto_matches_python(unchecked_contacts, self.pending_keys, self.mask_cache)
+
+        for day in new_keys.keys():
+            for epoch in new_keys[day].keys():
+                self.pending_keys.setdefault(day, {}).setdefault(epoch, []).extend(new_keys[day][epoch])
 
+        if len(self.contacts) > 0:
+            # Contacts are stored in chronological order up to the jitter.
+            self._prune_pending_keys(self.contacts.times[-1] - JITTER_THRESHOLD)
+
+        self.checked_contacts = self.contacts.added
+        self.keys_version = version
         return matches
 
+    def stream_crypto_matches(self, chunks: Iterable[Tuple[int, int, List[bytes]]]) -> Iterator[Match]:
+        """
+        Check for matching with the infected user, consuming the infected keys as a stream.
+        Memory depends on the size of a chunk and not on the size of the whole key database.
+
+        :param chunks:  iterable of (day, epoch, [epoch keys]), e.g. Server.iter_keys() or a reader of a key file.
+        :return:        iterator over the matches with the infected user, yielded chunk after chunk.
+        """
+        return stream_crypto_matches(self.contacts, chunks, self.mask_cache)
+
     def delete_my_keys(self, start_time: int, end_time: int) -> None:
         """
         Delete my keys in a time period.
@@ -126,35 +220,34 @@ class User:
         :note:                          only deleting key and not contacts.
         :return:
         """
-        start = Time(start_time)
-        end = Time(end_time)
-
         # TODO [RA]: what if end_time is in the future?
 
-        epoch_keys_to_delete = []
-
-        for time in self.epoch_keys.keys():
-            if start <= time <= end:
-                epoch_keys_to_delete.append(time)
-
-        for key in epoch_keys_to_delete:
-            del self.epoch_keys[key]
+        self.epoch_keys.delete_range(time_to_epoch_ordinal(start_time), time_to_epoch_ordinal(end_time))
+        self._drop_partial_day_keys()
+        self.ephid_schedule.clear()
 
-    def get_keys_for_server(self) -> UserKey:
+    def get_keys_for_server(self, use_day_keys: bool = False) -> UserKey:
         """
         Get a willing infected user keys.
         The keys will be sent to all user by the server.
 
+        :param use_day_keys:    send a single day key for every day whose epoch keys are all present,
+                                instead of its EPOCHS_IN_DAY pre-epoch keys.
         :return: Keys to be sent to the server.
         """
         # TODO I assume all currently existing keys are relevant.
         # Perhaps a 'checkup' is needed, i.e. remove old keys and so.
         # TODO similarly, one needs to make sure all non-deleted epoch keys
         #  are in self.epoch_keys (i.e. they were, at some point, derived from the daily key)
-        # TODO current version only sends epochs, i.e. does not try to reduce bandwidth by sending daily keys.
-
-        epochs = [(T.day, T.epoch, self.epoch_keys[T].preKey) for T in self.epoch_keys.keys()]
-        keys = UserKey(self.user_id, self.K_id, epochs, self.K_master_ver)
+        days = [(day, day_key) for day, day_key in self.day_keys.items()] if use_day_keys else []
+        whole_days = set(day for day, _ in days)
+
+        epochs = []
+        for ordinal in self.epoch_keys.ordinals():
+            day, epoch = split_epoch_ordinal(ordinal)
+            if day not in whole_days:
+                epochs.append((day, epoch, self.epoch_keys.get(ordinal).preKey))
+        keys = UserKey(self.user_id, self.K_id, epochs, self.K_master_ver, days)
         return keys
 
     def store_contact(self, other_ephemeral_id: bytes, rssi, time: int, own_location: bytes) -> bool:
@@ -165,19 +258,57 @@ class User:
         :param rssi:                ?
         :param time:                current time.
         :param own_location:        current location
-        :return:                    None.
-        """
-        if len(self.contacts) > 0 and time < self.contacts[-1].time - JITTER_THRESHOLD:
-            # We expect contacts to come in chronological order
-            # Up to jitter
-            return False
-        if len(self.contacts) >= MAX_CONTACTS_IN_WINDOW:
-            past_contact_time = self.contacts[-MAX_CONTACTS_IN_WINDOW].time
-            if time - past_contact_time < T_WINDOW:
-                # If there have been too many contacts in this epoch, ignore this contact.
-                return False
-        self.contacts.append(Contact(other_ephemeral_id, rssi, time, own_location))
-        return True
+        :return:                    True if the contact was stored.
+        """
+        return self.store_contacts([(other_ephemeral_id, rssi, time, own_location)])[0]
+
+    def store_contacts(self, contacts: List[Tuple[bytes, object, int, bytes]]) -> List[bool]:
+        """
+        Store many ephemeral ids at once, e.g. all the results of a BLE scan.
+        Every contact is accepted or rejected exactly as if store_contact was called on the contacts in order.
+
+        :param contacts:    list of (other ephemeral id, rssi, time, own location).
+        :return:            list of the store_contact results, in the order of contacts.
+        """
+        results = []
+        db = self.contacts
+        # Accepted contacts in insertion order, none earlier than the stored ones. They are appended at once.
+        batch = []
+        batch_times = []
+        for contact in contacts:
+            time = contact[2]
+            # The checks compare against the latest contacts in insertion order, as if each was stored on its own
+            recent = db.recent_times
+            count = len(db) + len(batch_times)
+            if count > 0 and time < (batch_times[-1] if len(batch_times) > 0 else recent[-1]) - JITTER_THRESHOLD:
+                # We expect contacts to come in chronological order
+                # Up to jitter
+                results.append(False)
+                continue
+            if count >= MAX_CONTACTS_IN_WINDOW:
+                if len(batch_times) >= MAX_CONTACTS_IN_WINDOW:
+                    past_contact_time = batch_times[-MAX_CONTACTS_IN_WINDOW]
+                else:
+                    past_contact_time = recent[len(batch_times) - MAX_CONTACTS_IN_WINDOW]
+                if time - past_contact_time < T_WINDOW:
+                    # If there have been too many contacts in this epoch, ignore this contact.
+                    results.append(False)
+                    continue
+            results.append(True)
+
+            latest = batch_times[-1] if len(batch_times) > 0 else (db.times[-1] if len(db) > 0 else None)
+            if latest is not None and time < latest:
+                # Out of order, inserted in its place
+                db.extend(batch)
+                batch = []
+                batch_times = []
+                db.add(*contact)
+            else:
+                batch.append(contact)
+                batch_times.append(time)
+
+        db.extend(batch)
+        return results
 
     def delete_contact(self, contact: Contact) -> None:
         """
@@ -186,7 +317,7 @@ class User:
         :param contact: Contact to delete.
         :return:
         """
-        self.contacts = [x for x in self.contacts if x != contact]
+        self.contacts.delete(contact)
 
     def delete_history(self, dtime: int) -> None:
         """
@@ -199,10 +330,12 @@ class User:
         """
         # Deletes all local information for time < dtime.
         # This include all keys and contacts.
-        t = Time(dtime)
-
-        self.epoch_keys = {x: y for x, y in self.epoch_keys.items() if x >= t}
-        self.contacts = [x for x in self.contacts if x.time >= dtime]
+        self.epoch_keys.delete_before(time_to_epoch_ordinal(dtime))
+        self._drop_partial_day_keys()
+        self.ephid_schedule.clear()
+        self.contacts.delete_before(dtime)
+        self._prune_pending_keys(dtime)
+        self.mask_cache.expire(time_to_day(dtime))
 
     def _get_epoch_keys(self, target_day: int) -> None:
         """
@@ -211,33 +344,42 @@ class User:
         :return:
         """
         # If all keys are present, nothing to be done.
-        if all([Time(target_day, epoch) in self.epoch_keys.keys() for epoch in range(EPOCHS_IN_DAY)]):
+        if self._has_day(target_day):
             return
         # Else, we need to generate keys.
         assert self.curr_day <= target_day, "Cannot retrieve keys from the past"
         while self.curr_day <= target_day:
             curr_day_key = DayKey(self.curr_day, self.curr_day_master_key,
                                   self.K_master_com, self.K_master_ver)
-            for epoch in range(EPOCHS_IN_DAY):
-                self.epoch_keys[Time(self.curr_day, epoch)] = EpochKey(self.curr_day, epoch, curr_day_key)
+            for epoch, epoch_key in enumerate(curr_day_key.epoch_keys()):
+                self.epoch_keys.set(epoch_ordinal(self.curr_day, epoch), epoch_key)
+            self.day_keys[self.curr_day] = curr_day_key.day
 
             self.curr_day += 1
             self.curr_day_master_key = get_next_day_master_key(self.curr_day_master_key, install_day=False)
 
+    def _drop_partial_day_keys(self) -> None:
+        """
+        Forget the day keys of days with deleted epoch keys, so deleted epochs can not be recovered or uploaded.
+        """
+        self.day_keys = {day: day_key for day, day_key in self.day_keys.items() if self._has_day(day)}
+
+    def _has_day(self, day: int) -> bool:
+        """
+        :return:    True if all epoch keys of day are present.
+        """
+        return all(self.epoch_keys.get(epoch_ordinal(day, epoch)) is not None for epoch in range(EPOCHS_IN_DAY))
+
+    def _prune_pending_keys(self, earliest_contact_time: int) -> None:
+        """
+        Drop the polled keys which cannot match contacts with time >= earliest_contact_time.
+        """
+        # Keys of epochs before the epoch of earliest end before it
+        earliest = time_to_epoch_ordinal(earliest_contact_time - JITTER_THRESHOLD)
+        earliest_day, _ = split_epoch_ordinal(earliest)
+        self.pending_keys = {day: {epoch: keys for epoch, keys in epochs.items() if epoch_ordinal(day, epoch) >= earliest}
+                             for day, epochs in self.pending_keys.items() if day >= earliest_day}
+
     @staticmethod
     def _is_match(mask: bytes, epoch_mac: bytes, contact: Contact) -> Tuple[bool, bytes, bytes]:
-        ephid = contact.EphID
-        plain = xor(mask, ephid)
-        zeros = plain[:3]
-        ephid_geohash = plain[3:3 + GEOHASH_LEN]
-        ephid_user_rand = plain[3 + GEOHASH_LEN:3 + GEOHASH_LEN + USER_RAND_LEN]
-
-        # First three bytes of plaintext are zero
-        if any([x != 0 for x in zeros]):
-            return False, bytes(0), bytes(0)
-
-        x = ephid[:-4] + mask[-4:]
-        y = ephid[-4:]
-        if y == encrypt(epoch_mac, x)[:4]:
-            return True, ephid_geohash, ephid_user_rand
-        return False, bytes(0), bytes(0)
+        return is_match(mask, epoch_mac, contact)
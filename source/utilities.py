@@ -1,29 +1,203 @@
 from __future__ import annotations
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from heapq import nlargest
+from typing import Iterator, List, Tuple
 from .keys import MESSAGE_LEN
-from .time import Time, T_DAY, T_EPOCH, T_UNIT
+from .time import T_UNIT, MAX_CONTACTS_IN_WINDOW
 
 
 class Match:
     def __init__(self, contact: Contact, ephid_geohash: bytes,
-                 ephid_user_rand: bytes, other_time: Time, other_unit: int):
+                 ephid_user_rand: bytes, other_unit: int):
         """
 
         :param contact:             Contact with the other user.
         :param ephid_geohash:       Other user ephemeral id.
         :param ephid_user_rand:     Other user proof.
-        :param other_time:          Other user epoch time of contact.
-        :param other_unit:          Other user time unit.
+        :param other_unit:          Other user time unit of contact, as a unit ordinal (see time.unit_ordinal).
         """
         self.contact = contact
         self.infected_geohash = ephid_geohash
         self.proof = ephid_user_rand
+        self.infected_unit = other_unit
         # Up to T_UNIT
-        self.infected_time = other_time.day * T_DAY + other_time.epoch * T_EPOCH + other_unit * T_UNIT
+        self.infected_time = other_unit * T_UNIT
 
 
 class ContactDB:
     def __init__(self):
-        pass
+        """
+        Contacts of a user, stored by column and kept sorted by time (contacts of equal time in insertion order).
+        Times and EphIDs are held in contiguous buffers, so the matching engines can read them without copying
+        (see ephid_view and time_view). RSSIs and locations are kept as given.
+        Every contact also gets its insertion count, so the contacts added after a point can be found (see added_since).
+        The times of the latest contacts in insertion order are kept too, for the checks of User.store_contacts.
+        Indexing gives Contact objects, built from the columns on access.
+        """
+        self.times = array('q')
+        self.rssis = []
+        self.ephids = bytearray()
+        self.locations = []
+        self.serials = array('q')
+        # Number of contacts ever added, the serial of the next contact
+        self.added = 0
+        # Times of the last MAX_CONTACTS_IN_WINDOW contacts in insertion order, the last inserted last
+        self.recent_times = deque(maxlen=MAX_CONTACTS_IN_WINDOW)
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            first, last, step = i.indices(len(self))
+            assert step == 1
+            return self.slice(first, max(first, last))
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return Contact(bytes(self.ephids[i * MESSAGE_LEN:(i + 1) * MESSAGE_LEN]), self.rssis[i], self.times[i],
+                       self.locations[i])
+
+    def __iter__(self) -> Iterator[Contact]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other) -> bool:
+        return len(self) == len(other) and all(x == y for x, y in zip(self, other))
+
+    def add(self, ephemeral_id: bytes, rssi, time: int, location: bytes) -> Contact:
+        """
+        Store a contact. Appending a contact which is not earlier than the last one takes constant time.
+
+        :param ephemeral_id:    The contact ephemeral id.
+        :param rssi:            RSSI of the BLE message.
+        :param time:            Time of contact as recorded by the receiving user.
+        :param location:        Location of user contact when BLE message received.
+        :return:                The stored contact.
+        """
+        assert len(ephemeral_id) == MESSAGE_LEN
+        i = bisect_right(self.times, time)
+        if i == len(self):
+            self.times.append(time)
+            self.rssis.append(rssi)
+            self.ephids += ephemeral_id
+            self.locations.append(location)
+            self.serials.append(self.added)
+        else:
+            self.times.insert(i, time)
+            self.rssis.insert(i, rssi)
+            self.ephids[i * MESSAGE_LEN:i * MESSAGE_LEN] = ephemeral_id
+            self.locations.insert(i, location)
+            self.serials.insert(i, self.added)
+        self.added += 1
+        self.recent_times.append(time)
+        return Contact(ephemeral_id, rssi, time, location)
+
+    def append(self, contact: Contact) -> None:
+        self.add(contact.EphID, contact.RSSI, contact.time, contact.location)
+
+    def extend(self, contacts: List[Tuple[bytes, object, int, bytes]]) -> None:
+        """
+        Append contacts with one copy per column.
+
+        :param contacts:    list of (ephemeral id, rssi, time, location) sorted by time,
+                            none earlier than the last stored contact.
+        """
+        if len(contacts) == 0:
+            return
+        ephids, rssis, times, locations = zip(*contacts)
+        assert len(self) == 0 or times[0] >= self.times[-1]
+        assert all(len(ephid) == MESSAGE_LEN for ephid in ephids)
+        self.times.extend(times)
+        self.rssis.extend(rssis)
+        self.ephids += b''.join(ephids)
+        self.locations.extend(locations)
+        self.serials.extend(range(self.added, self.added + len(contacts)))
+        self.added += len(contacts)
+        self.recent_times.extend(times)
+
+    def time_range(self, start_time: int, end_time: int) -> Tuple[int, int]:
+        """
+        :return:    (first, last) such that the contacts first to last - 1 are the contacts of time
+                    start_time <= time < end_time.
+        """
+        return bisect_left(self.times, start_time), bisect_left(self.times, end_time)
+
+    def delete_range(self, first: int, last: int) -> None:
+        """
+        Delete the contacts first to last - 1.
+        """
+        del self.times[first:last]
+        del self.rssis[first:last]
+        del self.ephids[first * MESSAGE_LEN:last * MESSAGE_LEN]
+        del self.locations[first:last]
+        del self.serials[first:last]
+        self._update_recent_times()
+
+    def _update_recent_times(self) -> None:
+        latest = sorted(nlargest(self.recent_times.maxlen, range(len(self)), key=self.serials.__getitem__),
+                        key=self.serials.__getitem__)
+        self.recent_times = deque((self.times[i] for i in latest), maxlen=self.recent_times.maxlen)
+
+    def delete_before(self, time: int) -> None:
+        """
+        Delete all contacts of time before time.
+        """
+        self.delete_range(0, bisect_left(self.times, time))
+
+    def delete(self, contact: Contact) -> None:
+        """
+        Delete all contacts equal to contact.
+        """
+        first, last = self.time_range(contact.time, contact.time + 1)
+        for i in reversed(range(first, last)):
+            if self[i] == contact:
+                self.delete_range(i, i + 1)
+
+    def ephid_view(self, first: int = 0, last: int = None) -> memoryview:
+        """
+        :return:    read only view of the EphIDs of the contacts first to last - 1, MESSAGE_LEN bytes each.
+                    The database can not grow or shrink while the view is alive.
+        """
+        last = len(self) if last is None else last
+        return memoryview(self.ephids)[first * MESSAGE_LEN:last * MESSAGE_LEN].toreadonly()
+
+    def time_view(self, first: int = 0, last: int = None) -> memoryview:
+        """
+        :return:    read only view of the times of the contacts first to last - 1.
+        """
+        last = len(self) if last is None else last
+        return memoryview(self.times)[first:last].toreadonly()
+
+    def slice(self, first: int, last: int) -> ContactDB:
+        """
+        :return:    a database holding a copy of the contacts first to last - 1.
+        """
+        db = ContactDB()
+        db.times = self.times[first:last]
+        db.rssis = self.rssis[first:last]
+        db.ephids = self.ephids[first * MESSAGE_LEN:last * MESSAGE_LEN]
+        db.locations = self.locations[first:last]
+        db.serials = self.serials[first:last]
+        db.added = self.added
+        db._update_recent_times()
+        return db
+
+    def added_since(self, serial: int) -> ContactDB:
+        """
+        :param serial:  a previous value of self.added.
+        :return:        a database holding a copy of the contacts added since, sorted by time.
+        """
+        db = ContactDB()
+        db.extend([(self.ephids[i * MESSAGE_LEN:(i + 1) * MESSAGE_LEN], self.rssis[i], self.times[i], self.locations[i])
+                   for i in range(len(self)) if self.serials[i] >= serial])
+        return db
+
+    def clear(self) -> None:
+        self.delete_range(0, len(self))
 
 
 class Contact:
@@ -0,0 +1,150 @@
+"""
+Binary format of the keys published by the server.
+
+    header:     magic (4 bytes), format version (uint32), number of buckets (uint32)
+    directory:  one entry per (day, epoch) bucket: day (uint32), epoch (uint32), offset (uint64), count (uint64)
+    keys:       the epoch keys of every bucket, as contiguous arrays of KEY_LEN bytes
+
+All integers are little endian. Offsets are in bytes from the beginning of the file.
+"""
+
+from __future__ import annotations
+import mmap
+import struct
+from typing import Iterable, Iterator, List, Tuple
+
+KEY_LEN = 16
+MAGIC = b'HSKF'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sII')
+DIRECTORY_ENTRY = struct.Struct('<IIQQ')
+
+
+def encode_key_file(chunks: Iterable[Tuple[int, int, List[bytes]]]) -> bytes:
+    """
+    Serialize published keys.
+    :param chunks:  iterable of (day, epoch, [epoch keys]), e.g. Server.iter_keys(). Each (day, epoch) at most once.
+    :return:        the serialized keys.
+    """
+    chunks = [(day, epoch, b''.join(keys)) for day, epoch, keys in chunks]
+    assert len(set((day, epoch) for day, epoch, _ in chunks)) == len(chunks), "Buckets must be unique"
+
+    parts = [HEADER.pack(MAGIC, FORMAT_VERSION, len(chunks))]
+    offset = HEADER.size + DIRECTORY_ENTRY.size * len(chunks)
+    for day, epoch, keys in chunks:
+        assert len(keys) % KEY_LEN == 0, "Keys must be of size {}".format(KEY_LEN)
+        parts.append(DIRECTORY_ENTRY.pack(day, epoch, offset, len(keys) // KEY_LEN))
+        offset += len(keys)
+    parts.extend(keys for _, _, keys in chunks)
+    return b''.join(parts)
+
+
+def write_key_file(path: str, chunks: Iterable[Tuple[int, int, List[bytes]]]) -> None:
+    with open(path, 'wb') as f:
+        f.write(encode_key_file(chunks))
+
+
+class KeyArray:
+    def __init__(self, buffer: memoryview):
+        """
+        Read-only sequence of epoch keys stored contiguously in a buffer. Keys are returned as memoryviews (no copy).
+
+        :param buffer:  memoryview of count * KEY_LEN bytes.
+        """
+        self.buffer = buffer
+
+    def __len__(self) -> int:
+        return len(self.buffer) // KEY_LEN
+
+    def __getitem__(self, i: int) -> memoryview:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("key index out of range")
+        return self.buffer[i * KEY_LEN:(i + 1) * KEY_LEN]
+
+    def __iter__(self) -> Iterator[memoryview]:
+        for i in range(0, len(self.buffer), KEY_LEN):
+            yield self.buffer[i:i + KEY_LEN]
+
+
+class KeyFile:
+    def __init__(self, buffer):
+        """
+        Zero-copy reader of serialized keys.
+        Behaves like the dictionary returned by Server.send_keys (self[day][epoch] is a sequence of keys),
+        so it can be passed to the matching code as is.
+
+        :param buffer:  the serialized keys (bytes, bytearray, mmap, ...).
+        """
+        self._mmap = None
+        self._view = memoryview(buffer)
+        magic, version, count = HEADER.unpack_from(self._view, 0)
+        assert magic == MAGIC, "Not a key file"
+        assert version == FORMAT_VERSION, "Unsupported key file version {}".format(version)
+
+        self.epochs = {}
+        for i in range(count):
+            day, epoch, offset, keys = DIRECTORY_ENTRY.unpack_from(self._view, HEADER.size + i * DIRECTORY_ENTRY.size)
+            assert offset + keys * KEY_LEN <= len(self._view), "Truncated key file"
+            self.epochs.setdefault(day, {})[epoch] = KeyArray(self._view[offset:offset + keys * KEY_LEN])
+
+    @classmethod
+    def open(cls, path: str) -> KeyFile:
+        """
+        Memory map a key file written by write_key_file.
+        """
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        key_file = cls(mapped)
+        key_file._mmap = mapped
+        return key_file
+
+    def close(self) -> None:
+        """
+        Unmap the file. Keys taken from this reader must be dropped before closing it.
+        """
+        for epochs in self.epochs.values():
+            for keys in epochs.values():
+                keys.buffer.release()
+        self.epochs = {}
+        self._view.release()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self) -> KeyFile:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __getitem__(self, day: int) -> dict:
+        return self.epochs[day]
+
+    def __contains__(self, day: int) -> bool:
+        return day in self.epochs
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.epochs)
+
+    def __len__(self) -> int:
+        return len(self.epochs)
+
+    def get(self, day: int, default=None):
+        return self.epochs.get(day, default)
+
+    def keys(self):
+        return self.epochs.keys()
+
+    def items(self):
+        return self.epochs.items()
+
+    def chunks(self) -> Iterator[Tuple[int, int, KeyArray]]:
+        """
+        Iterate over the buckets in chronological order, for User.stream_crypto_matches.
+        :return:    iterator over (day, epoch, keys).
+        """
+        for day in sorted(self.epochs.keys()):
+            for epoch in sorted(self.epochs[day].keys()):
+                yield day, epoch, self.epochs[day][epoch]
@@ -0,0 +1,38 @@
+from HashomerCryptoRef.benchmarks.suite import BENCHMARKS, Params, run_benchmarks, save_results, load_results, compare
+from HashomerCryptoRef.benchmarks.simulator import SimulationParams, Simulator
+
+
+def test_benchmarks(tmp_path):
+    """
+    Every benchmark runs on a small scenario, and results compare against themselves without regressions.
+    (positive test)
+    """
+    params = Params(infected_users=2, contacts_per_user=2, retention_days=2)
+    results = run_benchmarks(params)
+
+    assert list(results.keys()) == list(BENCHMARKS.keys())
+    assert all(result.throughput > 0 and result.peak_memory is not None for result in results.values())
+
+    path = str(tmp_path / 'results.json')
+    save_results(path, params, results)
+    baseline = load_results(path)
+    assert baseline['params'] == params.to_dict()
+    assert [regressed for _, _, _, regressed in compare(results, baseline)] == [False] * len(BENCHMARKS)
+    baseline['results']['send_keys']['throughput'] *= 10
+    assert [name for name, _, _, regressed in compare(results, baseline) if regressed] == ['send_keys']
+
+
+def test_simulator():
+    """
+    The simulation is deterministic, and every contact with an infected user is matched and verified.
+    (positive test)
+    """
+    params = SimulationParams(population=30, days=1, infected_fraction=0.2, places=5, seed=3)
+    results = Simulator(params).run()
+
+    counts = results['counts']
+    assert counts['matches'] > 0
+    assert counts['matches'] == counts['expected_matches'] == counts['verified']
+    assert list(results['stages'].keys()) == ['create_users', 'movement', 'advertise', 'encounters', 'store_contacts',
+                                              'upload', 'matching', 'verification']
+    assert Simulator(params).run()['counts'] == counts
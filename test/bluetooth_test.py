@@ -1,6 +1,7 @@
 from HashomerCryptoRef.source.user import User
 from HashomerCryptoRef.source.server import Server
-from HashomerCryptoRef.source.time import Time, day_to_second
+from HashomerCryptoRef.source.time import Time, day_to_second, epoch_ordinal, EPOCHS_IN_DAY, T_EPOCH
+from HashomerCryptoRef.source.time import T_UNIT, UNITS_IN_EPOCH
 
 
 def test_key_derivation():
@@ -116,3 +117,98 @@ def test_updating_database():
     user_a.update_key_databases(day_to_second(110), day_to_second(115))
 
     assert min(user_a.epoch_keys.keys()) == Time(day_to_second(110))
+
+
+def test_lazy_epoch_keys():
+    """
+    Epoch keys are derived on first use only.
+    (positive test)
+    """
+    install_time = day_to_second(100)
+    target_time = day_to_second(105) + 4000
+    geohash = bytes([0] * 5)
+
+    user = User(bytes([1] * 16), bytes([2] * 16), install_time)
+    user.update_key_databases(install_time, target_time)
+
+    assert all(epoch_key._epoch is None for epoch_key in user.epoch_keys.values())
+    _ = user.generate_ephemeral_id(target_time, geohash)
+    used = [t for t, epoch_key in user.epoch_keys.items() if epoch_key._epoch is not None]
+    assert used == [Time(target_time)]
+
+
+def test_deleted_keys_not_recoverable():
+    """
+    Once an epoch key is deleted, the day key of its day is not kept by the remaining epoch keys.
+    (positive test)
+    """
+    install_time = day_to_second(100)
+    user = User(bytes([1] * 16), bytes([2] * 16), install_time)
+    user.update_key_databases(install_time, day_to_second(102))
+
+    deleted_time = day_to_second(101) + 3 * T_EPOCH
+    deleted = Time(deleted_time)
+    k_day = user.day_keys[101]
+    user.delete_my_keys(deleted_time, deleted_time)
+
+    assert deleted not in user.epoch_keys
+    assert 101 not in user.day_keys
+    remaining = user.epoch_keys[Time(day_to_second(101) + 4 * T_EPOCH)]
+    assert not any(value == k_day for value in (remaining.preKey, remaining.material.commit, remaining.material.verification))
+    assert not hasattr(remaining, 'k_day')
+
+
+def test_epoch_key_store():
+    """
+    The epoch key store keeps the keys of a user by epoch ordinal.
+    (positive test)
+    """
+    install_time = day_to_second(100)
+    user = User(bytes([1] * 16), bytes([2] * 16), install_time)
+    user.update_key_databases(install_time, day_to_second(103))
+    assert len(user.epoch_keys) == 4 * EPOCHS_IN_DAY
+
+    # Delete a range in the middle, then the history before it
+    user.delete_my_keys(day_to_second(101) + 3 * T_EPOCH, day_to_second(101) + 5 * T_EPOCH)
+    assert len(user.epoch_keys) == 4 * EPOCHS_IN_DAY - 3
+    assert Time(day_to_second(101) + 4 * T_EPOCH) not in user.epoch_keys
+    assert 101 not in user.day_keys
+    user.delete_history(day_to_second(101) + 4 * T_EPOCH)
+    assert min(user.epoch_keys.keys()) == Time(day_to_second(101) + 6 * T_EPOCH)
+    assert user.epoch_keys.get(epoch_ordinal(102, 7)) is user.epoch_keys[Time(102, 7)]
+    assert user.epoch_keys.get(epoch_ordinal(101, 0)) is None
+
+
+def test_ephemeral_id_schedule():
+    """
+    The ephemeral ids generated for a whole day at once are those of generate_ephemeral_id.
+    (positive test)
+    """
+    install_time = day_to_second(100)
+    user = User(bytes([1] * 16), bytes([2] * 16), install_time)
+    home, work = bytes([1] * 5), bytes([2] * 5)
+    timeline = [(install_time, home), (install_time + 8 * T_EPOCH, work), (install_time + 17 * T_EPOCH + 600, home)]
+
+    schedule = user.generate_ephemeral_ids(100, timeline)
+
+    assert len(schedule) == EPOCHS_IN_DAY * UNITS_IN_EPOCH
+    for unit, ephid in enumerate(schedule):
+        time = install_time + unit * T_UNIT
+        geo_hash = work if 8 * T_EPOCH <= time - install_time < 17 * T_EPOCH + 600 else home
+        assert ephid == user.generate_ephemeral_id(time + 7, geo_hash)
+
+    # Cached schedule, regenerated when the location changes
+    assert user.get_scheduled_ephemeral_id(install_time + 30, home) == schedule[0]
+    assert user.get_scheduled_ephemeral_id(install_time + 8 * T_EPOCH, work) == schedule[8 * UNITS_IN_EPOCH]
+    assert user.get_scheduled_ephemeral_id(install_time + 20 * T_EPOCH, work) == \
+        user.generate_ephemeral_id(install_time + 20 * T_EPOCH, work)
+    assert user.ephid_schedule[100][:2] == (work, 8 * UNITS_IN_EPOCH)
+
+    user.delete_my_keys(install_time + 21 * T_EPOCH, install_time + 21 * T_EPOCH)
+    assert len(user.ephid_schedule) == 0
+
+    # A deleted epoch has no ids, the other epochs of the day are still scheduled
+    assert user.get_scheduled_ephemeral_id(install_time + 8 * T_EPOCH, work) == schedule[8 * UNITS_IN_EPOCH]
+    assert user.get_scheduled_ephemeral_id(install_time + 22 * T_EPOCH, home) == \
+        user.generate_ephemeral_id(install_time + 22 * T_EPOCH, home)
+    assert user.generate_ephemeral_ids(100, timeline)[21 * UNITS_IN_EPOCH:22 * UNITS_IN_EPOCH] == [None] * UNITS_IN_EPOCH
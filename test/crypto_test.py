@@ -1,5 +1,5 @@
 from HashomerCryptoRef.source.bytes_utils import hex_to_bytes, pad
-from HashomerCryptoRef.source.crypto import encrypt, hmac_sha256
+from HashomerCryptoRef.source.crypto import encrypt, encrypt_many, hmac_sha256, Encryptor, HmacKey, HmacCache
 
 KEY_SIZE = 16
 
@@ -31,3 +31,42 @@ def test_hmac():
 
     key = pad(key, KEY_SIZE)
     assert hmac_sha256(key, message) == expected_signature, "HMAC test failed"
+
+
+def test_aes_many():
+    """
+    Batched encryption must agree with block by block encryption, and a reused encryptor must be stateless.
+    (positive test)
+    """
+    key = hex_to_bytes('000102030405060708090a0b0c0d0e0f')
+    blocks = [bytes([i] * KEY_SIZE) for i in range(40)]
+
+    expected = [encrypt(key, block) for block in blocks]
+    assert encrypt_many(key, blocks) == expected
+    assert encrypt_many(key, []) == []
+
+    encryptor = Encryptor(key)
+    assert encryptor.encrypt_many(blocks[:3]) == expected[:3]
+    assert [encryptor.encrypt(block) for block in blocks] == expected
+
+
+def test_hmac_cache():
+    """
+    A keyed HMAC context must agree with hmac_sha256 on every message, and the cache must stay bounded.
+    (positive test)
+    """
+    keys = [bytes([i] * KEY_SIZE) for i in range(4)]
+    messages = [b'', b'message', bytes(range(200))]
+
+    hmac_key = HmacKey(keys[0])
+    for message in messages:
+        assert hmac_key.digest(message) == hmac_sha256(keys[0], message)
+
+    cache = HmacCache(max_keys=2)
+    for key in keys:
+        for message in messages:
+            assert cache.get(key).digest(message) == hmac_sha256(key, message)
+    assert len(cache) == 2
+    assert cache.get(keys[-1]) is cache.get(bytearray(keys[-1]))
+    cache.clear()
+    assert len(cache) == 0
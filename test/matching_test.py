@@ -0,0 +1,271 @@
+import random
+import pytest
+from HashomerCryptoRef.source.user import User
+from HashomerCryptoRef.source.server import Server
+from HashomerCryptoRef.source.time import Time, T_UNIT, T_EPOCH, JITTER_THRESHOLD, day_to_second
+from HashomerCryptoRef.source.time import unit_ordinal, time_to_unit_ordinal, time_to_epoch_ordinal, split_unit_ordinal
+from HashomerCryptoRef.source.bytes_utils import num_to_bytes
+from HashomerCryptoRef.source.crypto import encrypt
+from HashomerCryptoRef.source.derivation_utils import get_epoch_keys
+from HashomerCryptoRef.source.keys import MESSAGE_LEN
+from HashomerCryptoRef.source.matching import use_numpy, MaskCache
+from HashomerCryptoRef.source.wire import KeyFile, encode_key_file
+from HashomerCryptoRef.source import stats
+
+
+def build_scenario(seed: int = 7, infected_count: int = 4, contacts_per_user: int = 6):
+    """
+    Infected users broadcast, a single observer stores their EphIDs (with jitter) and some noise.
+    :return:    the observer and the server message.
+    """
+    rng = random.Random(seed)
+    install_time = day_to_second(100)
+    last_time = day_to_second(102)
+
+    observer = User(bytes([200] * 16), bytes([201] * 16), install_time)
+    server = Server()
+
+    sightings = []
+    for i in range(infected_count):
+        infected = User(bytes([i + 1] * 16), bytes([i + 50] * 16), install_time)
+        infected.update_key_databases(install_time, last_time)
+        for _ in range(contacts_per_user):
+            time = rng.randrange(install_time, last_time)
+            geo_hash = bytes(rng.randrange(256) for _ in range(5))
+            ephid = infected.generate_ephemeral_id(time, geo_hash)
+            sightings.append((time + rng.randrange(-JITTER_THRESHOLD // 2, JITTER_THRESHOLD // 2), ephid))
+        server.receive_user_key(infected.get_keys_for_server())
+
+    for _ in range(contacts_per_user):
+        sightings.append((rng.randrange(install_time, last_time), bytes(rng.randrange(256) for _ in range(16))))
+
+    for time, ephid in sorted(sightings):
+        assert observer.store_contact(ephid, None, time, bytes([0] * 5))
+
+    return observer, server.send_keys()
+
+
+def naive_matches(user: User, infected_key_database: dict) -> list:
+    """
+    Reference matching: every contact against every mask in its jitter window.
+    """
+    result = []
+    for contact in sorted(user.contacts, key=lambda c: c.time):
+        time = contact.time - JITTER_THRESHOLD
+        while time <= contact.time + JITTER_THRESHOLD:
+            t = Time(time)
+            unit = t.get_units()
+            time += T_UNIT
+            for epoch_key in infected_key_database.get(t.day, {}).get(t.epoch, []):
+                epoch_enc, epoch_mac = get_epoch_keys(epoch_key, t.day, t.epoch)
+                mask = encrypt(epoch_enc, num_to_bytes(unit, MESSAGE_LEN))
+                match = User._is_match(mask, epoch_mac, contact)
+                if match[0]:
+                    result.append((contact.time, contact.EphID, match[1], match[2], t.day, t.epoch, unit))
+    return result
+
+
+def as_tuples(matches: list) -> list:
+    return [(m.contact.time, m.contact.EphID, m.infected_geohash, m.proof,
+             Time(m.infected_time).day, Time(m.infected_time).epoch,
+             (m.infected_time % T_EPOCH) // T_UNIT) for m in matches]
+
+
+def test_hash_join_matching():
+    """
+    Indexed matching must find exactly the matches of the exhaustive scan, in the same order.
+    (positive test)
+    """
+    observer, server_msg = build_scenario()
+    expected = naive_matches(observer, server_msg)
+
+    matches = observer.find_crypto_matches(server_msg)
+
+    assert len(expected) >= 4 * 6
+    assert as_tuples(matches) == expected
+
+
+def test_time_ordinals():
+    """
+    Unit and epoch ordinals agree with Time, and matching skips long gaps between contacts.
+    (positive test)
+    """
+    rng = random.Random(3)
+    for _ in range(1000):
+        time = rng.randrange(day_to_second(20000))
+        t = Time(time)
+        assert split_unit_ordinal(time_to_unit_ordinal(time)) == (t.day, t.epoch, t.get_units())
+        assert unit_ordinal(t.day, t.epoch, t.get_units()) == t.get_unit_ordinal() == time // T_UNIT
+        assert time_to_epoch_ordinal(time) == t.get_epoch_ordinal()
+
+    observer, server_msg = build_scenario(seed=17)
+    # Years after the other contacts
+    observer.store_contact(bytes(16), None, day_to_second(2000), bytes([0] * 5))
+
+    assert as_tuples(observer.find_crypto_matches(server_msg)) == naive_matches(observer, server_msg)
+
+
+@pytest.mark.skipif(not use_numpy, reason="numpy is not installed")
+def test_numpy_matching():
+    """
+    The vectorized engine must return exactly the matches of the pure python engine.
+    (positive test)
+    """
+    observer, server_msg = build_scenario(seed=11)
+
+    matches = observer.find_crypto_matches(server_msg, use_numpy=True)
+
+    assert as_tuples(matches) == as_tuples(observer.find_crypto_matches(server_msg))
+    assert as_tuples(matches) == naive_matches(observer, server_msg)
+    assert observer.find_crypto_matches({}, use_numpy=True) == []
+
+
+def test_parallel_matching():
+    """
+    Matching sharded by day over a process pool must return the sequential matches, in the same order.
+    (positive test)
+    """
+    observer, server_msg = build_scenario(seed=13)
+    expected = as_tuples(observer.find_crypto_matches(server_msg))
+
+    matches = observer.find_crypto_matches(server_msg, parallel=True, max_workers=2)
+
+    assert as_tuples(matches) == expected
+    assert all(m.contact in observer.contacts for m in matches)
+
+
+def test_mask_cache():
+    """
+    Masks derived in one call are reused by the next ones, and the cache stays bounded.
+    (positive test)
+    """
+    observer, server_msg = build_scenario(seed=17)
+    expected = naive_matches(observer, server_msg)
+
+    assert as_tuples(observer.find_crypto_matches(server_msg)) == expected
+    cached = len(observer.mask_cache)
+    assert cached > 0
+    assert as_tuples(observer.find_crypto_matches(server_msg)) == expected
+    assert len(observer.mask_cache) == cached
+
+    # With more keys than max_keys, the kept entries are still reused by repeated calls
+    observer.mask_cache = MaskCache(max_keys=5)
+    assert as_tuples(observer.find_crypto_matches(server_msg)) == expected
+    assert len(observer.mask_cache) == 5
+    kept = set(observer.mask_cache._entries.keys())
+    first_hits = observer.mask_cache.hits
+    assert as_tuples(observer.find_crypto_matches(server_msg)) == expected
+    assert set(observer.mask_cache._entries.keys()) == kept
+    assert observer.mask_cache.hits - first_hits > first_hits
+
+    observer.mask_cache = MaskCache(retention_days=1)
+    assert as_tuples(observer.find_crypto_matches(server_msg)) == expected
+    assert all(day == observer.mask_cache.latest_day for day, _, _ in observer.mask_cache._entries.keys())
+    observer.mask_cache.expire(observer.mask_cache.latest_day + 1)
+    assert len(observer.mask_cache) == 0
+
+
+def test_streaming_matching():
+    """
+    Matching a stream of (day, epoch, keys) chunks must find the same matches as matching the whole database.
+    (positive test)
+    """
+    observer, server_msg = build_scenario(seed=19)
+    expected = naive_matches(observer, server_msg)
+
+    chunks = [(day, epoch, keys) for day in sorted(server_msg) for epoch in sorted(server_msg[day])
+              for keys in (server_msg[day][epoch][:2], server_msg[day][epoch][2:])]
+    matches = list(observer.stream_crypto_matches(iter(chunks)))
+
+    assert sorted(as_tuples(matches)) == sorted(expected)
+
+
+def test_key_file_matching(tmp_path):
+    """
+    Matching against a memory mapped key file must find the same matches as matching against send_keys.
+    (positive test)
+    """
+    observer, server_msg = build_scenario(seed=23)
+    expected = naive_matches(observer, server_msg)
+    chunks = [(day, epoch, server_msg[day][epoch]) for day in sorted(server_msg) for epoch in sorted(server_msg[day])]
+    path = str(tmp_path / "keys.bin")
+    with open(path, 'wb') as f:
+        f.write(encode_key_file(chunks))
+
+    key_file = KeyFile.open(path)
+    assert {day: {epoch: [bytes(key) for key in keys] for epoch, keys in key_file[day].items()}
+            for day in key_file} == server_msg
+    assert as_tuples(observer.find_crypto_matches(key_file)) == expected
+    assert sorted(as_tuples(observer.stream_crypto_matches(key_file.chunks()))) == sorted(expected)
+    key_file.close()
+
+
+def test_poll_matching():
+    """
+    Polling the keys published since the last poll must eventually find every match of a full re-check,
+    including contacts stored after the keys they match were polled.
+    (positive test)
+    """
+    install_time = day_to_second(100)
+    contact_time = day_to_second(101) + 1000
+    geo_hash = bytes([0] * 5)
+    observer = User(bytes([200] * 16), bytes([201] * 16), install_time)
+    infected = [User(bytes([i + 1] * 16), bytes([i + 50] * 16), install_time) for i in range(3)]
+    for user in infected:
+        user.update_key_databases(install_time, contact_time + day_to_second(1))
+    server = Server()
+
+    # the first infected user uploads keys which include the future, before the contact happens
+    server.receive_user_key(infected[0].get_keys_for_server())
+    version, new_keys = server.send_keys_since(observer.keys_version)
+    assert version == 1
+    assert observer.poll_crypto_matches(version, new_keys) == []
+
+    for i, user in enumerate(infected):
+        assert observer.store_contact(user.generate_ephemeral_id(contact_time + i, geo_hash), None,
+                                      contact_time + i, geo_hash)
+    server.receive_user_key(infected[1].get_keys_for_server())
+
+    version, new_keys = server.send_keys_since(observer.keys_version)
+    assert version == 2
+    assert sum(len(keys) for epochs in new_keys.values() for keys in epochs.values()) == 24 * 3
+    matches = observer.poll_crypto_matches(version, new_keys)
+
+    assert sorted(as_tuples(matches)) == sorted(as_tuples(observer.find_crypto_matches(server.send_keys())))
+    assert len(matches) == 2
+    assert server.send_keys_since(version) == (version, {})
+    assert observer.poll_crypto_matches(*server.send_keys_since(version)) == []
+
+    # a contact stored after the poll, before the latest contact, matches the polled keys exactly once
+    late_time = contact_time + 1
+    assert observer.store_contact(infected[0].generate_ephemeral_id(late_time, geo_hash), None, late_time, geo_hash)
+    late_matches = observer.poll_crypto_matches(*server.send_keys_since(version))
+    assert [m.contact.time for m in late_matches] == [late_time]
+    assert observer.poll_crypto_matches(*server.send_keys_since(version)) == []
+
+
+def test_instrumentation():
+    """
+    Enabled instrumentation counts the crypto operations and matching stages, disabled it collects nothing.
+    (positive test)
+    """
+    observer, server_msg = build_scenario(seed=23)
+    events = []
+
+    collected = stats.enable(trace_memory=True, hook=lambda name, value: events.append(name))
+    try:
+        matches = observer.find_crypto_matches(server_msg)
+    finally:
+        stats.disable()
+
+    counters = dict(collected.counters)
+    assert counters['matching.matches'] == len(matches) > 0
+    assert counters['matching.contacts'] == len(observer.contacts)
+    assert counters['matching.mac_checks'] >= len(matches)
+    assert counters['crypto.aes_blocks'] >= counters['crypto.aes_calls'] > 0
+    assert set(collected.timers.keys()) == {'matching.window', 'matching.masks'}
+    assert [label for label, _ in collected.snapshots] == ['find_crypto_matches']
+    assert 'matching.matches' in events and 'crypto.aes_calls' in events
+
+    observer.find_crypto_matches(server_msg)
+    assert collected.counters == counters
@@ -197,7 +197,29 @@ def test_user_delete_past_data():
 
 def test_server_delete_past_data():
     """
-    A test to check that the user deletes ephemeral data from more then 14 days ago.
+    A test to check that the server deletes ephemeral data from more then 14 days ago.
     (positive test)
     """
-    pass
+    id_a = bytes([1] + [0] * 15)
+    key_a = bytes(i + 2 for i in range(16))
+    install_time_a = day_to_second(100)
+
+    user_a = User(id_a, key_a, install_time_a)
+    user_a.update_key_databases(install_time_a, day_to_second(103))
+    proof = user_a.epoch_keys[Time(day_to_second(100))].epochVER[:4]
+
+    server = Server()
+    server.receive_user_key(user_a.get_keys_for_server())
+    assert sorted(server.send_keys().keys()) == [100, 101, 102, 103]
+    assert server.verify_contact(100, 0, proof)
+
+    # with a 14 days retention, day 114 keeps days 101-114
+    server.expire(114)
+
+    assert sorted(server.send_keys().keys()) == [101, 102, 103]
+    assert sorted(server.send_keys_since(0)[1].keys()) == [101, 102, 103]
+    assert not server.verify_contact(100, 0, proof)
+
+    # old keys which are sent again are not stored
+    server.receive_user_key(user_a.get_keys_for_server())
+    assert sorted(server.send_keys().keys()) == [101, 102, 103]
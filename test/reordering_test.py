@@ -1,7 +1,7 @@
 from HashomerCryptoRef.source.time import T_DAY
 from HashomerCryptoRef.source.user import User
 from HashomerCryptoRef.source.server import Server
-from HashomerCryptoRef.source.utilities import Contact
+from HashomerCryptoRef.source.utilities import Contact, ContactDB
 
 
 def day_to_seconds(day):
@@ -105,3 +105,39 @@ def test_ordering_server():
     for day in server_message.keys():
         for epoch in server_message[day].keys():
             assert sorted(server_message[day][epoch]) == server_message[day][epoch]
+
+
+def test_contact_db():
+    """
+    The contact database keeps its contacts sorted by time, whatever the insertion order.
+    (positive test)
+    """
+    geo_hash = bytes([0] * 5)
+    contacts = [Contact(bytes([i] * 16), -60 - i if i % 2 else None, day_to_seconds(105) + t, geo_hash)
+                for i, t in enumerate([30, 10, 20, 10, 50, 40])]
+
+    db = ContactDB()
+    for contact in contacts:
+        db.append(contact)
+
+    expected = sorted(contacts, key=lambda c: c.time)
+    assert db == expected
+    assert list(db.times) == [c.time for c in expected]
+    assert bytes(db.ephid_view(1, 3)) == expected[1].EphID + expected[2].EphID
+    assert db[1:3] == expected[1:3]
+
+    db.delete(contacts[3])
+    assert contacts[3] not in db and len(db) == 5
+    db.delete_before(day_to_seconds(105) + 30)
+    assert db == [c for c in expected if c.time >= day_to_seconds(105) + 30]
+    first, last = db.time_range(day_to_seconds(105) + 40, day_to_seconds(105) + 50)
+    db.delete_range(first, last)
+    assert [c.time - day_to_seconds(105) for c in db] == [30, 50]
+
+    # RSSIs and locations are stored as given
+    odd = [Contact(bytes([7] * 16), rssi, day_to_seconds(106), location)
+           for rssi, location in [(-70.5, geo_hash), (40000, geo_hash), (-0x8000, bytes(3)), (None, bytes(3))]]
+    db.extend([(c.EphID, c.RSSI, c.time, c.location) for c in odd[:2]])
+    for contact in odd[2:]:
+        db.append(contact)
+    assert list(db)[2:] == odd
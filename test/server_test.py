@@ -1,6 +1,11 @@
 from HashomerCryptoRef.source.user import User
 from HashomerCryptoRef.source.server import Server
-from HashomerCryptoRef.source.time import day_to_second
+from HashomerCryptoRef.source.time import Time, day_to_second
+from HashomerCryptoRef.source.wire import KeyFile
+from HashomerCryptoRef.source.storage import FileStore
+from HashomerCryptoRef.source.ingest import IngestPipeline
+from HashomerCryptoRef.source.derivation_utils import expand_day_keys
+from HashomerCryptoRef.source.crypto import HMAC_CACHE
 
 
 def duplicate_message_test():
@@ -32,3 +37,242 @@ def duplicate_message_test():
     second_keys = user_a.get_keys_for_server()
     server.receive_user_key(second_keys)
     _ = server.send_keys()
+
+
+def test_write_keys(tmp_path):
+    """
+    The key file written by the server must hold exactly the keys of send_keys.
+    (positive test)
+    """
+    install_time = day_to_second(100)
+    server = Server()
+    for i in range(3):
+        user = User(bytes([i + 1] * 16), bytes([i + 7] * 16), install_time)
+        user.update_key_databases(install_time, install_time + day_to_second(1))
+        server.receive_user_key(user.get_keys_for_server())
+
+    path = str(tmp_path / "keys.bin")
+    server.write_keys(path)
+
+    with KeyFile.open(path) as key_file:
+        assert [(day, epoch, [bytes(key) for key in keys]) for day, epoch, keys in key_file.chunks()] == \
+            list(server.iter_keys())
+
+
+def test_bulk_receive():
+    """
+    Receiving many user keys at once must publish the same keys as receiving them one by one, as one version.
+    (positive test)
+    """
+    install_time = day_to_second(100)
+    users = [User(bytes([i + 1] * 16), bytes([i + 7] * 16), install_time) for i in range(5)]
+    for user in users:
+        user.update_key_databases(install_time, install_time + day_to_second(1))
+
+    HMAC_CACHE.clear()
+    one_by_one = Server()
+    for user in users:
+        one_by_one.receive_user_key(user.get_keys_for_server())
+    bulk = Server()
+    bulk.receive_user_keys([user.get_keys_for_server() for user in users])
+
+    assert bulk.send_keys() == one_by_one.send_keys()
+    assert bulk.version == 1 and one_by_one.version == 5
+    # The uploaders' master verification keys are not kept by the server
+    assert len(HMAC_CACHE) == 0
+    for day, epoch, keys in bulk.iter_keys():
+        assert keys == sorted(keys)
+
+
+def test_verify_contacts():
+    """
+    Batched verification must agree with verify_contact and with the stored verification keys.
+    (positive and negative test)
+    """
+    install_time = day_to_second(100)
+    users = [User(bytes([i + 1] * 16), bytes([i + 7] * 16), install_time) for i in range(3)]
+    server = Server()
+    for user in users:
+        server.receive_user_key(user.get_keys_for_server())
+
+    day = users[0].curr_day - 1
+    claims = [(day, epoch, user.epoch_keys[Time(day, epoch)].epochVER[:4]) for user in users for epoch in (0, 5)]
+    claims += [(day, 1, bytes(4)), (day + 5, 0, claims[0][2]), (day, 6, claims[0][2])]
+
+    assert server.verify_contacts(claims) == [True] * 6 + [False] * 3
+    assert server.verify_contacts(claims) == [server.verify_contact(*claim) for claim in claims]
+
+
+def test_file_store(tmp_path):
+    """
+    A server on a file store must behave like the in-memory server, and survive a restart.
+    (positive test)
+    """
+    install_time = day_to_second(100)
+    users = [User(bytes([i + 1] * 16), bytes([i + 7] * 16), install_time) for i in range(4)]
+    for user in users:
+        user.update_key_databases(install_time, install_time + day_to_second(1))
+    proofs = [(100, epoch, user.epoch_keys[Time(100, epoch)].epochVER[:4]) for user in users for epoch in (0, 23)]
+    claims = proofs + [(100, 1, proofs[0][2]), (101, 0, bytes(4)), (99, 0, proofs[0][2])]
+
+    memory = Server()
+    server = Server(store=FileStore(str(tmp_path)))
+    for user in users[:2]:
+        memory.receive_user_key(user.get_keys_for_server())
+        server.receive_user_key(user.get_keys_for_server())
+    assert server.verify_contacts(claims) == memory.verify_contacts(claims)
+    for user in users[2:]:
+        memory.receive_user_key(user.get_keys_for_server())
+        server.receive_user_key(user.get_keys_for_server())
+
+    assert server.send_keys() == memory.send_keys()
+    assert server.send_keys_since(2) == memory.send_keys_since(2)
+    assert server.verify_contacts(claims) == memory.verify_contacts(claims) == [True] * 8 + [False] * 3
+    server.store.close()
+
+    # An interrupted append leaves a partial record, which must not shift the records appended after it
+    with open(str(tmp_path / '100.keys'), 'ab') as f:
+        f.write(bytes(10))
+    restarted = Server(store=FileStore(str(tmp_path)))
+    assert restarted.version == 4
+    assert restarted.send_keys() == memory.send_keys()
+    assert restarted.verify_contacts(claims) == memory.verify_contacts(claims)
+
+    late_user = User(bytes([9] * 16), bytes([10] * 16), install_time)
+    late_user.update_key_databases(install_time, install_time + day_to_second(1))
+    with open(str(tmp_path / '101.keys'), 'ab') as f:
+        f.write(bytes(10))
+    memory.receive_user_key(late_user.get_keys_for_server())
+    restarted.receive_user_key(late_user.get_keys_for_server())
+    assert restarted.send_keys() == memory.send_keys()
+    assert restarted.send_keys_since(4) == memory.send_keys_since(4)
+
+    restarted.expire(114)
+    memory.expire(114)
+    assert restarted.send_keys() == memory.send_keys()
+    assert sorted(restarted.send_keys().keys()) == [101]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['101.keys', 'server.state']
+
+    # A batch whose days have all expired leaves no records, its version must not be issued again after a restart
+    restarted.expire(116)
+    restarted.receive_user_key(late_user.get_keys_for_server())
+    assert restarted.version == 6 and restarted.send_keys() == {}
+    restarted.store.close()
+
+    restarted = Server(store=FileStore(str(tmp_path)))
+    assert restarted.version == 6 and restarted.oldest_day == 103
+    restarted.receive_user_key(late_user.get_keys_for_server())
+    assert restarted.send_keys() == {}
+    fresh_user = User(bytes([11] * 16), bytes([12] * 16), day_to_second(116))
+    restarted.receive_user_key(fresh_user.get_keys_for_server())
+    version, new_keys = restarted.send_keys_since(6)
+    assert version == 8 and sorted(new_keys.keys()) == [116]
+    restarted.store.close()
+
+
+def test_ingest_pipeline():
+    """
+    Keys ingested through the worker pool must be published exactly like keys received directly.
+    (positive test)
+    """
+    install_time = day_to_second(100)
+    users = [User(bytes([i + 1] * 16), bytes([i + 7] * 16), install_time) for i in range(10)]
+
+    expected = Server()
+    for user in users:
+        expected.receive_user_key(user.get_keys_for_server())
+
+    for use_threads in (True, False):
+        server = Server()
+        with IngestPipeline(server, max_workers=2, batch_size=4, use_threads=use_threads) as pipeline:
+            for user in users:
+                user_key = user.get_keys_for_server()
+                pipeline.submit(user_key)
+                assert not hasattr(user_key, 'K_ID')
+        stats = pipeline.stats()
+
+        assert server.send_keys() == expected.send_keys()
+        assert stats['submitted'] == stats['committed'] == 10
+        assert stats['committed_keys'] == 10 * 24
+        assert stats['queue_depth'] == 0
+        assert server.version == stats['commits']
+
+    # A trickle of uploads which never fills a batch is committed once it has waited max_delay
+    server = Server()
+    with IngestPipeline(server, max_workers=1, batch_size=64, use_threads=True, max_delay=0) as pipeline:
+        pipeline.submit(users[0].get_keys_for_server())
+        assert pipeline.queue_depth == 0
+        pipeline.max_delay = 3600
+        pipeline.submit(users[1].get_keys_for_server())
+        pipeline.poll()
+        assert pipeline.queue_depth == 1 and server.version == 1
+        pipeline.max_delay = 0
+        pipeline.poll()
+        assert pipeline.queue_depth == 0 and server.version == 2
+
+
+def test_ingest_failure():
+    """
+    A malformed upload is skipped, the uploads around it are still committed.
+    (negative test)
+    """
+    install_time = day_to_second(100)
+    users = [User(bytes([i + 1] * 16), bytes([i + 7] * 16), install_time) for i in range(3)]
+    user_keys = [user.get_keys_for_server() for user in users]
+    user_keys[1].K_masterVER = bytes(5)
+
+    expected = Server()
+    expected.receive_user_keys([users[0].get_keys_for_server(), users[2].get_keys_for_server()])
+
+    server = Server()
+    with IngestPipeline(server, max_workers=1, use_threads=True) as pipeline:
+        for user_key in user_keys:
+            pipeline.submit(user_key)
+    stats = pipeline.stats()
+
+    assert server.send_keys() == expected.send_keys()
+    assert stats['committed'] == 2 and stats['failed'] == 1 and stats['queue_depth'] == 0
+    assert isinstance(pipeline.last_error, AssertionError)
+
+
+def test_day_key_upload(tmp_path):
+    """
+    Keys uploaded as day keys must be published and verified exactly like the same keys uploaded as epoch keys.
+    (positive test)
+    """
+    install_time = day_to_second(100)
+    users = [User(bytes([i + 1] * 16), bytes([i + 7] * 16), install_time) for i in range(3)]
+    for user in users:
+        user.update_key_databases(install_time, install_time + day_to_second(2))
+    # a deleted epoch must not be recoverable from the upload, so day 101 of the first user is sent as epochs
+    users[0].delete_my_keys(day_to_second(101) + 3600, day_to_second(101) + 3600)
+    claims = [(day, epoch, user.epoch_keys[Time(day, epoch)].epochVER[:4])
+              for user in users for day in (100, 102) for epoch in (0, 23)]
+
+    epoch_server = Server()
+    day_server = Server()
+    for user in users:
+        epoch_server.receive_user_key(user.get_keys_for_server())
+        user_key = user.get_keys_for_server(use_day_keys=True)
+        assert len(user_key.preEpoch) == (23 if user is users[0] else 0)
+        day_server.receive_user_key(user_key)
+
+    assert day_server.verify_contacts(claims) == [True] * len(claims)
+    assert day_server.send_keys() == epoch_server.send_keys()
+    assert day_server.send_keys_since(1) == epoch_server.send_keys_since(1)
+
+    day_keys, epoch_keys = day_server.send_day_keys()
+    assert [len(day_keys[day]) for day in (100, 101, 102)] == [3, 2, 3]
+    assert sum(len(keys) for epochs in epoch_keys.values() for keys in epochs.values()) == 23
+    assert expand_day_keys(day_keys, epoch_keys) == epoch_server.send_keys()
+
+    # On a file store, day keys must survive a restart before the keys are read
+    file_server = Server(store=FileStore(str(tmp_path)))
+    file_server.receive_user_key(users[1].get_keys_for_server(use_day_keys=True))
+    file_server.store.close()
+    restarted = Server(store=FileStore(str(tmp_path)))
+    assert restarted.version == 1
+    single_server = Server()
+    single_server.receive_user_key(users[1].get_keys_for_server())
+    assert restarted.send_keys() == single_server.send_keys()
+    restarted.store.close()
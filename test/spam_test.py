@@ -1,4 +1,5 @@
-from HashomerCryptoRef.source.time import day_to_second, T_UNIT
+import random
+from HashomerCryptoRef.source.time import day_to_second, T_UNIT, JITTER_THRESHOLD, T_WINDOW, MAX_CONTACTS_IN_WINDOW
 from HashomerCryptoRef.source.user import User
 
 
@@ -59,3 +60,57 @@ def dos_test():
     assert user_a.store_contact(eph_b, rssi, install_time + day_to_second(3), geo_hash)
 
     assert len(user_a.contacts) == 1001
+
+
+def test_store_contacts():
+    """
+    Storing a burst of contacts at once accepts and rejects the same contacts as storing them one by one.
+    (positive and negative test)
+    """
+    rng = random.Random(5)
+    install_time = day_to_second(100)
+    geo_hash = bytes([0] * 5)
+
+    one_by_one = User(bytes([1] * 16), bytes([2] * 16), install_time)
+    batched = User(bytes([1] * 16), bytes([2] * 16), install_time)
+
+    time = install_time
+    bursts = []
+    for i in range(40):
+        burst = []
+        # A run of dense bursts hits the rate limit
+        steps = [0, 0, 0, 1] if 10 <= i < 30 else [0, 1, 3, T_WINDOW // 5]
+        for _ in range(rng.randrange(1, 200)):
+            # Mostly in order, with some late contacts (part of them beyond the jitter)
+            time += rng.choice(steps)
+            contact_time = time - rng.choice([0] * 8 + [JITTER_THRESHOLD // 2, 2 * JITTER_THRESHOLD])
+            burst.append((bytes(rng.randrange(256) for _ in range(16)), rng.choice([None, -70]), contact_time, geo_hash))
+        bursts.append(burst)
+
+    # Reference checks, against the contacts in insertion order
+    inserted = []
+
+    def reference_store(contact_time):
+        if len(inserted) > 0 and contact_time < inserted[-1] - JITTER_THRESHOLD:
+            return False
+        if len(inserted) >= MAX_CONTACTS_IN_WINDOW and contact_time - inserted[-MAX_CONTACTS_IN_WINDOW] < T_WINDOW:
+            return False
+        inserted.append(contact_time)
+        return True
+
+    results = []
+    for burst in bursts:
+        expected = [one_by_one.store_contact(*contact) for contact in burst]
+        assert expected == [reference_store(contact[2]) for contact in burst]
+        assert batched.store_contacts(burst) == expected
+        results += expected
+
+    assert True in results and False in results
+    assert batched.contacts == one_by_one.contacts
+    assert batched.contacts.added == one_by_one.contacts.added
+
+    # The order check compares against the last contact inserted, not the latest in time
+    user = User(bytes([1] * 16), bytes([2] * 16), install_time)
+    times = [install_time + t for t in (1000, 900, 350, 300, 200)]
+    assert user.store_contacts([(bytes(16), None, t, geo_hash) for t in times]) == [True] * 5
+    assert list(user.contacts.times) == sorted(times)